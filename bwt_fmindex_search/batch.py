@@ -0,0 +1,143 @@
+from collections import OrderedDict
+
+# Default number of (pattern suffix, suffix array interval) entries kept between batches
+interval_cache_size = 1 << 16
+
+
+class IntervalCache:
+    """ Suffix array intervals of recently searched pattern suffixes, evicted in least recently used order """
+    def __init__(self, capacity=interval_cache_size):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._intervals = OrderedDict()
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def get(self, suffix):
+        interval = self._intervals.get(suffix)
+        if interval is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._intervals.move_to_end(suffix)
+        return interval
+
+    def put(self, suffix, interval):
+        self._intervals[suffix] = interval
+        self._intervals.move_to_end(suffix)
+        if len(self._intervals) > self.capacity:
+            self._intervals.popitem(last=False)
+
+
+class BatchPlanner:
+    """ Searches batches of patterns on fm_index so that every distinct pattern suffix is searched once.
+     Reversed patterns are sorted, which visits trie of reversed patterns in depth first order, and common
+     prefixes of a pattern with all later ones give the nodes where they branch off. Intervals of those nodes
+     are kept on path, and backward search of every pattern continues from the deepest node it shares with
+     earlier patterns, so steps are taken once per trie edge character.
+     Intervals of pattern and branching nodes are kept in IntervalCache keyed by reversed suffix,
+     so suffixes searched in earlier batches take no steps at all. """
+    def __init__(self, fm_index, cache_size=interval_cache_size):
+        self.fm_index = fm_index
+        self.cache = IntervalCache(cache_size)
+        self.patterns = 0
+        self.steps = 0
+
+    def stats(self):
+        """ Returns counts of searched patterns, backward steps and cache hits and misses since creation """
+        return {
+            "patterns": self.patterns,
+            "steps": self.steps,
+            "steps_per_pattern": self.steps / self.patterns if self.patterns else 0,
+            "cache_hits": self.cache.hits,
+            "cache_misses": self.cache.misses,
+            "cache_entries": len(self.cache),
+        }
+
+    def query_intervals(self, patterns):
+        """ Returns suffix array interval (start, end) of every pattern, in order of patterns.
+         Interval (0, 0) means that pattern does not occur in text. """
+        self.patterns += len(patterns)
+        reversed_patterns = {}
+        for i, pattern in enumerate(patterns):
+            if pattern:
+                reversed_patterns.setdefault(pattern[::-1], []).append(i)
+        keys = sorted(reversed_patterns)
+        intervals = [(0, 0)] * len(patterns)
+        # common prefix length of every key and the next one, the last key has only the root in common
+        common_lengths = [common_prefix_length(key, next_key) for key, next_key in zip(keys, keys[1:])] + [0]
+        # later keys branch off every key at running minima of common_lengths from that key onward,
+        # kept increasing on stack while keys are visited from the last one
+        branch_depths = [None] * len(keys)
+        minima = []
+        for k in reversed(range(len(keys))):
+            while minima and minima[-1] >= common_lengths[k]:
+                minima.pop()
+            minima.append(common_lengths[k])
+            previous_length = common_lengths[k - 1] if k else 0
+            depths = []
+            for depth in reversed(minima):
+                if depth <= previous_length:
+                    break
+                depths.append(depth)
+            branch_depths[k] = depths[::-1]
+        # (depth, interval) of trie nodes on path to current pattern, depth increasing from the root
+        path = [(0, (0, len(self.fm_index._bwt)))]
+        previous = ""
+        for k, key in enumerate(keys):
+            while path[-1][0] > common_prefix_length(previous, key):
+                path.pop()
+            depth, interval = path[-1]
+            for branch_depth in branch_depths[k]:
+                if depth < branch_depth < len(key):
+                    interval = self._search(key, depth, branch_depth, interval)
+                    depth = branch_depth
+                    path.append((depth, interval))
+            interval = self._search(key, depth, len(key), interval)
+            path.append((len(key), interval))
+            if interval[0] < interval[1]:
+                for i in reversed_patterns[key]:
+                    intervals[i] = interval
+            previous = key
+        return intervals
+
+    def query(self, patterns):
+        """ Returns list of positions of every pattern, in order of patterns """
+        return [self.fm_index._find_suffixes(range(start_index, end_index))
+                for start_index, end_index in self.query_intervals(patterns)]
+
+    def _search(self, key, depth, target_depth, interval):
+        """ Returns interval of key[:target_depth] reversed, from cache or by backward steps
+         continuing from interval of key[:depth] reversed """
+        suffix = key[:target_depth]
+        cached = self.cache.get(suffix)
+        if cached is not None:
+            return cached
+        f_column = self.fm_index._f_column
+        start_index, end_index = interval
+        for c in key[depth:target_depth]:
+            if start_index == end_index:
+                break
+            code = f_column._codes.get(c)
+            if code is None:
+                start_index, end_index = 0, 0
+                break
+            self.steps += 1
+            first_rank, count = self.fm_index._find_preceders(start_index, end_index, code)
+            start_index = f_column.code_first_occurrence(code) + first_rank
+            end_index = start_index + count
+        if start_index == end_index:
+            start_index, end_index = 0, 0
+        self.cache.put(suffix, (start_index, end_index))
+        return start_index, end_index
+
+
+def common_prefix_length(first, second):
+    """ Returns length of the longest common prefix of two strings """
+    length = min(len(first), len(second))
+    for i in range(length):
+        if first[i] != second[i]:
+            return i
+    return length
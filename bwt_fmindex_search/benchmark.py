@@ -1,51 +1,378 @@
+import json
+import math
+import multiprocessing
+import platform
+import random
+import sys
 import time
+import tracemalloc
 
+try:
+    import resource
+except ImportError:
+    # peak RSS is not reported on platforms without resource module
+    resource = None
+
+from fasta import *
 from fmindex_optimized import *
 from util import *
 
 sa_factors = [4, 16, 64, 256]
 tally_factors = [8, 32, 128, 512]
 
+# (sa_factor, tally_factor) pairs measured by benchmark suite for every corpus and backend
+suite_factors = [(4, 8), (32, 64)]
+suite_corpora = ["dna", "repetitive", "natural", "large_alphabet"]
+suite_percentiles = [50, 95, 99]
+# metrics compared against baseline and whether larger values are better
+suite_metrics = {
+    "build_seconds": False,
+    "queries_per_second": True,
+    "latency_p95_ms": False,
+    "latency_p99_ms": False,
+    "peak_traced_bytes": False,
+    "index_bytes": False,
+}
+# sa_factor and tally_factor values considered by tuner
+tuning_factors = [1 << i for i in range(10)]
+natural_words = ["the", "of", "and", "to", "in", "a", "is", "that", "for", "it", "as", "was", "with", "be", "by",
+                 "on", "not", "he", "this", "are", "or", "his", "from", "at", "which", "but", "have", "an", "had",
+                 "they", "you", "were", "their", "one", "all", "we", "can", "her", "has", "there", "been", "if",
+                 "more", "when", "will", "would", "who", "so", "no", "index", "search", "pattern", "suffix", "text"]
+
 
 def read_fasta_file(file):
-    result = []
-    for line in file:
-        if line[0] != '>':
-            result.append(line.rstrip().upper())
-    result.append(terminal_char)
-    return ''.join(result)
+    text, _ = read_sequences(file)
+    return text + terminal_char
+
+
+def benchmark_sa_builders(text, builder_names, repeats=3):
+    """ Returns best out of repeats construction time of suffix array for every named algorithm """
+    results = []
+    for name in builder_names:
+        builder = sa_builders[name]
+        times = []
+        for _ in range(repeats):
+            start_time = time.process_time()
+            builder(text)
+            end_time = time.process_time()
+            times.append(end_time - start_time)
+        results.append((name, len(text), min(times)))
+    return results
+
+
+def generate_corpus(kind, length, seed):
+    """ Returns synthetic text of given kind and length, always the same for the same seed """
+    rng = random.Random(seed)
+    if kind == "dna":
+        return "".join(rng.choices("ACGT", k=length))
+    if kind == "repetitive":
+        # copies of one unit, each with about one mutation per thousand characters
+        unit = rng.choices("ACGT", k=1000)
+        text = []
+        while len(text) < length:
+            copy = list(unit)
+            for _ in range(len(copy) // 1000):
+                copy[rng.randrange(len(copy))] = rng.choice("ACGT")
+            text.extend(copy)
+        return "".join(text[:length])
+    if kind == "natural":
+        # words with Zipf distributed frequencies
+        weights = [1 / rank for rank in range(1, len(natural_words) + 1)]
+        text = []
+        size = 0
+        while size < length:
+            word = rng.choices(natural_words, weights)[0] + rng.choice("     ,.")
+            text.append(word)
+            size += len(word)
+        return "".join(text)[:length]
+    if kind == "large_alphabet":
+        return "".join(chr(0x100 + rng.randrange(1000)) for _ in range(length))
+    raise ValueError("Unknown corpus kind " + kind)
+
+
+def generate_patterns(text, count, length, seed):
+    """ Returns count patterns of given length, always the same for the same seed.
+     Half of them are substrings of text and half are random strings over its alphabet, mostly absent. """
+    rng = random.Random(seed)
+    alphabet = sorted(set(text))
+    patterns = []
+    for i in range(count):
+        if i % 2 == 0:
+            start = rng.randrange(len(text) - length + 1)
+            patterns.append(text[start:start + length])
+        else:
+            patterns.append("".join(rng.choices(alphabet, k=length)))
+    return patterns
+
+
+def percentile(sorted_values, p):
+    """ Returns p-th percentile of sorted values by nearest rank """
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def build_timed(text, sa_factor, tally_factor, backend):
+    """ Builds FM index of text and returns it with construction time of every step """
+    t = terminate_string(text)
+    start_time = time.perf_counter()
+    sa = suffix_array_sais(t)
+    sa_time = time.perf_counter()
+    f_column, bwt, sa_sample, _ = create_index_components(t, sa, sa_factor)
+    bwt_time = time.perf_counter()
+    tally = rank_backends[backend](bwt, tally_factor, len(f_column.alphabet))
+    tally_time = time.perf_counter()
+    fm_index = FMIndex(bwt if isinstance(tally, Tally) else tally, sa_sample, tally, f_column)
+    return fm_index, {"sa": sa_time - start_time, "bwt": bwt_time - sa_time, "tally": tally_time - bwt_time}
+
+
+def benchmark_configuration(configuration):
+    """ Measures build times, query throughput, latency percentiles and peak memory of one configuration.
+     Every time is the best out of repeats runs, latencies are taken per pattern.
+     Memory is measured in a separate build and query run, so tracing does not slow down timed runs. """
+    text = generate_corpus(configuration["corpus"], configuration["length"], configuration["seed"])
+    patterns = generate_patterns(text, configuration["patterns"], configuration["pattern_length"],
+                                 configuration["seed"] + 1)
+    factors = (configuration["sa_factor"], configuration["tally_factor"], configuration["backend"])
+    build_times = None
+    latencies = [math.inf] * len(patterns)
+    for _ in range(configuration["repeats"]):
+        fm_index, times = build_timed(text, *factors)
+        build_times = times if build_times is None else {step: min(build_times[step], times[step]) for step in times}
+        for i, pattern in enumerate(patterns):
+            start_time = time.perf_counter()
+            fm_index.query(pattern)
+            latencies[i] = min(latencies[i], time.perf_counter() - start_time)
+        del fm_index
+
+    tracemalloc.start()
+    fm_index, _ = build_timed(text, *factors)
+    for pattern in patterns:
+        fm_index.query(pattern)
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    result = dict(configuration)
+    result["build_seconds"] = sum(build_times.values())
+    result.update(("build_" + step + "_seconds", seconds) for step, seconds in build_times.items())
+    result["queries_per_second"] = len(latencies) / sum(latencies) if sum(latencies) else 0
+    result.update(("latency_p%d_ms" % p, percentile(latencies, p) * 1000) for p in suite_percentiles)
+    result["peak_traced_bytes"] = peak_traced
+    result["memory"] = fm_index.memory_report()
+    result["index_bytes"] = result["memory"]["total"]
+    # maximum resident set size of the worker process, in kilobytes on Linux and bytes on macOS
+    result["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+    return result
+
+
+def suite_configurations(length, pattern_count, pattern_length, seed, repeats=3):
+    return [{"corpus": corpus, "backend": backend, "sa_factor": sa_factor, "tally_factor": tally_factor,
+             "length": length, "patterns": pattern_count, "pattern_length": pattern_length, "seed": seed,
+             "repeats": repeats}
+            for corpus in suite_corpora for backend in sorted(rank_backends) for sa_factor, tally_factor in suite_factors]
+
+
+def run_suite(configurations):
+    """ Runs every configuration in a fresh worker process, so peak RSS of one does not hide the next one """
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        results = pool.map(benchmark_configuration, configurations, chunksize=1)
+    return {
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "processor": platform.processor()},
+        "results": results,
+    }
+
+
+def predict_memory_report(length, f_column, sa_factor, tally_factor):
+    """ Returns memory report that FMIndex with tally backend of terminated text of given length would have,
+     computed from sizes of its arrays without building it """
+    itemsize = array(index_typecode(length)).itemsize
+    alphabet_size = len(f_column.alphabet)
+    marks_size = (length + 7) // 8
+    block_ranks = (marks_size + rank_block_size - 1) // rank_block_size + 1
+    report = {
+        "bwt": length if alphabet_size <= 256 else length * array(index_typecode(alphabet_size)).itemsize,
+        "tally": alphabet_size * ((length + tally_factor - 1) // tally_factor + 1) * itemsize,
+        "sa_sample": marks_size + block_ranks * array('I' if length < 2 ** 32 else 'Q').itemsize
+                     + (length + sa_factor - 1) // sa_factor * itemsize,
+        "f_column": f_column.memory_usage(),
+        "kmer_table": 0,
+        "isa_sample": 0,
+    }
+    report["total"] = sum(report.values())
+    return report
+
+
+def tune_factors(text, patterns, memory_budget, factors=tuning_factors, repeats=2):
+    """ Returns (sa_factor, tally_factor) of the fastest FM index with tally backend whose memory report
+     total fits in memory_budget bytes, with list of measured candidates, or None if nothing fits.
+     Footprints of all pairs of factors are predicted without building them. For every sa_factor only
+     the smallest fitting tally_factor is measured, as larger ones only scan more BWT characters.
+     Latency is the best out of repeats runs of count and locate of every pattern. """
+    t = terminate_string(text)
+    sa = suffix_array_sais(t)
+    f_column = create_f_column(t)
+    bwt = create_encoded_bwt(t, sa, f_column)
+    candidates = []
+    for sa_factor in factors:
+        fitting = [tally_factor for tally_factor in factors
+                   if predict_memory_report(len(t), f_column, sa_factor, tally_factor)["total"] <= memory_budget]
+        if not fitting:
+            continue
+        tally_factor = min(fitting)
+        fm_index = FMIndex(bwt, create_sa_sample(sa, sa_factor),
+                           create_tally(bwt, tally_factor, len(f_column.alphabet)), f_column)
+        seconds = math.inf
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            for pattern in patterns:
+                fm_index.count(pattern)
+                fm_index.query(pattern)
+            seconds = min(seconds, time.perf_counter() - start_time)
+        candidates.append({"sa_factor": sa_factor, "tally_factor": tally_factor,
+                           "memory_bytes": fm_index.memory_report()["total"],
+                           "seconds_per_pattern": seconds / len(patterns) if patterns else 0})
+    if not candidates:
+        return None, candidates
+    best = min(candidates, key=lambda candidate: candidate["seconds_per_pattern"])
+    return (best["sa_factor"], best["tally_factor"]), candidates
+
+
+def configuration_key(result):
+    return tuple(result[name] for name in
+                 ["corpus", "backend", "sa_factor", "tally_factor", "length", "patterns", "pattern_length", "seed"])
+
+
+def compare_with_baseline(report, baseline, tolerance):
+    """ Returns descriptions of metrics that are worse than in baseline report by more than tolerance fraction.
+     Only configurations present in both reports are compared. """
+    baseline_results = {configuration_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        previous = baseline_results.get(configuration_key(result))
+        if previous is None:
+            continue
+        for metric, larger_is_better in suite_metrics.items():
+            old, new = previous.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (old - new) / old if larger_is_better else (new - old) / old
+            if change > tolerance:
+                regressions.append("%s %s sa_factor=%d tally_factor=%d: %s %.4g -> %.4g (%+.0f%%)" % (
+                    result["corpus"], result["backend"], result["sa_factor"], result["tally_factor"],
+                    metric, old, new, change * 100))
+    return regressions
 
 
 if __name__ == "__main__":
     # create command line arguments parser
     parser = argparse.ArgumentParser(description='BWT + FM index for string search.')
-    parser.add_argument("-i", "--input", required=True, help="Path to text file.")
-    parser.add_argument("-p", "--patterns", required=True, help="Path to patterns file.")
+    parser.add_argument("-i", "--input", required=False, help="Path to text file. Required unless --suite is given.")
+    parser.add_argument("-p", "--patterns", required=False, help="Path to patterns file. Required unless --sa_only is given.")
     parser.add_argument("-o", "--output", required=False, help="Path to output results file. If omitted, results will be printed to standard output.")
+    parser.add_argument("--sa_only", action="store_true",
+                        help="Only measure suffix array construction time of algorithms given with --sa_algorithms.")
+    parser.add_argument("--sa_algorithms", nargs="+", choices=sorted(sa_builders), default=sorted(sa_builders),
+                        help="Suffix array construction algorithms to measure. If omitted, all of them are measured.")
+    parser.add_argument("--suite", action="store_true",
+                        help="Run benchmark suite on synthetic corpora generated from --seed and write JSON report.")
+    parser.add_argument("--length", type=positive_int, default=20000, required=False,
+                        help="Length of every synthetic corpus of benchmark suite.")
+    parser.add_argument("--pattern_count", type=positive_int, default=500, required=False,
+                        help="Number of patterns searched in every configuration of benchmark suite.")
+    parser.add_argument("--pattern_length", type=positive_int, default=12, required=False,
+                        help="Length of patterns searched by benchmark suite.")
+    parser.add_argument("--seed", type=int, default=42, required=False, help="Seed of synthetic corpora and patterns.")
+    parser.add_argument("--repeats", type=positive_int, default=3, required=False,
+                        help="Number of runs of every configuration of benchmark suite. The best time of each measurement is reported.")
+    parser.add_argument("--baseline", required=False,
+                        help="Path to JSON report of earlier benchmark suite run. Regressions against it are reported and make exit status 1.")
+    parser.add_argument("--tolerance", type=float, default=0.2, required=False,
+                        help="Fraction by which a metric may be worse than in baseline before it is reported as regression.")
+    parser.add_argument("--tune", action="store_true",
+                        help="Find sa_factor and tally_factor of the fastest index of input text and patterns that fits in --memory_budget.")
+    parser.add_argument("--memory_budget", type=positive_int, required=False,
+                        help="Number of bytes index built with --tune may take.")
+    parser.add_argument("--fasta", action="store_true",
+                        help="Input of --tune is FASTA or FASTQ file. If omitted, it is read as plain text without line breaks.")
     args = vars(parser.parse_args())
 
+    if args["tune"]:
+        if not args["input"] or not args["patterns"] or not args["memory_budget"]:
+            parser.error("--tune requires -i/--input, -p/--patterns and --memory_budget")
+        if args["fasta"]:
+            with open(args["input"], 'rb') as input_file:
+                text = read_fasta_file(input_file)
+        else:
+            with open(args["input"], 'r') as input_file:
+                text = ''.join(input_file.read().splitlines())
+        with open(args["patterns"], 'r') as pattern_file:
+            patterns = pattern_file.read().splitlines()
+        factors, candidates = tune_factors(text, patterns, args["memory_budget"])
+        report_json = json.dumps({"sa_factor": factors[0] if factors else None,
+                                  "tally_factor": factors[1] if factors else None,
+                                  "candidates": candidates}, indent=2)
+        if args["output"]:
+            with open(args["output"], 'w') as f:
+                f.write(report_json)
+        else:
+            print(report_json)
+        sys.exit(0 if factors else 1)
+    if args["suite"]:
+        report = run_suite(suite_configurations(args["length"], args["pattern_count"], args["pattern_length"],
+                                                args["seed"], args["repeats"]))
+        report_json = json.dumps(report, indent=2)
+        if args["output"]:
+            with open(args["output"], 'w') as f:
+                f.write(report_json)
+        else:
+            print(report_json)
+        if args["baseline"]:
+            with open(args["baseline"], 'r') as f:
+                regressions = compare_with_baseline(report, json.load(f), args["tolerance"])
+            for regression in regressions:
+                print("Regression: " + regression, file=sys.stderr)
+            sys.exit(1 if regressions else 0)
+        sys.exit()
+    if not args["input"]:
+        parser.error("the following arguments are required: -i/--input")
+
     input_path = args["input"]
     patterns_path = args["patterns"]
     output_path = args["output"]
 
-    with open(input_path, 'r') as input_file, open(patterns_path, 'r') as pattern_file:
+    if args["sa_only"]:
+        with open(input_path, 'rb') as input_file:
+            text = read_fasta_file(input_file)
+        results = benchmark_sa_builders(text, args["sa_algorithms"])
+        lines = "\n".join([" ".join(str(e) for e in result) for result in results])
+        if output_path:
+            with open(output_path, 'w') as f:
+                f.writelines(lines)
+        else:
+            print(lines)
+        sys.exit()
+    if not patterns_path:
+        parser.error("the following arguments are required: -p/--patterns")
+
+    with open(input_path, 'rb') as input_file, open(patterns_path, 'r') as pattern_file:
         text = read_fasta_file(input_file)
         patterns = pattern_file.read().splitlines()
-    sa = suffix_array_manber_myers(text)
-    bwt = bw_transform(text, sa)
-    bwt_size = get_size(bwt)
+    sa = suffix_array_sais(text)
     f_column = create_f_column(text)
-    f_column_size = get_size(f_column._zero_rank_indices) + get_size(f_column._counts)
+    bwt = create_encoded_bwt(text, sa, f_column)
+    bwt_size = buffer_size(bwt)
+    f_column_size = f_column.memory_usage()
 
 
     results = []
     for sa_factor in sa_factors:
         sa_sample = create_sa_sample(sa, sa_factor)
-        sa_sample_size = get_size(sa_sample)
+        sa_sample_size = sa_sample.memory_usage()
         for tally_factor in tally_factors:
-            tally = create_tally(bwt, tally_factor)
+            tally = create_tally(bwt, tally_factor, len(f_column.alphabet))
             fm_index = FMIndex(bwt, sa_sample, tally, f_column)
-            tally_size = get_size(tally.ranks)
+            tally_size = tally.memory_usage()
             for pattern in patterns:
                 start_time = time.process_time()
                 query_count = fm_index.query(pattern)
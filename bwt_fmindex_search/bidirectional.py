@@ -0,0 +1,99 @@
+from operator import sub
+
+from fmindex_optimized import *
+
+
+class BidirectionalInterval:
+    """ Rows prefixed by the same string in index of text and rows prefixed by its reverse in index of reversed text.
+     Both intervals have the same size, so they are kept as two start rows and one size. """
+    def __init__(self, index, forward_start, reverse_start, size):
+        self.index = index
+        self.forward_start = forward_start
+        self.reverse_start = reverse_start
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return "BidirectionalInterval(%d, %d, %d)" % (self.forward_start, self.reverse_start, self.size)
+
+    def forward_range(self):
+        return self.forward_start, self.forward_start + self.size
+
+    def reverse_range(self):
+        return self.reverse_start, self.reverse_start + self.size
+
+    def extend_left(self, c):
+        """ Returns interval of string preceded by character c """
+        forward_start, reverse_start, size = self.index._extend(self.index.forward, self.forward_start,
+                                                                self.reverse_start, self.size, c)
+        return BidirectionalInterval(self.index, forward_start, reverse_start, size)
+
+    def extend_right(self, c):
+        """ Returns interval of string followed by character c """
+        reverse_start, forward_start, size = self.index._extend(self.index.reverse, self.reverse_start,
+                                                                self.forward_start, self.size, c)
+        return BidirectionalInterval(self.index, forward_start, reverse_start, size)
+
+    def locate(self):
+        """ Returns positions of the string in text, in suffix array order """
+        return self.index.forward._find_suffixes(range(self.forward_start, self.forward_start + self.size))
+
+
+class BidirectionalFMIndex:
+    """ FM indexes of text and of reversed text, searched together with synchronized intervals.
+     Stepping backward in one index narrows the other one to rows whose next symbol is the added one,
+     so a match can be extended to the left and to the right in any order without searching it again. """
+    def __init__(self, forward, reverse):
+        self.forward = forward
+        self.reverse = reverse
+
+    def memory_report(self):
+        """ Returns memory reports of both indexes and their total """
+        forward = self.forward.memory_report()
+        reverse = self.reverse.memory_report()
+        return {"forward": forward, "reverse": reverse, "total": forward["total"] + reverse["total"]}
+
+    def interval(self):
+        """ Returns interval of the empty string, holding every row """
+        return BidirectionalInterval(self, 0, 0, len(self.forward._bwt))
+
+    def search(self, pattern):
+        """ Returns interval of pattern, extending it to the right one character at a time """
+        interval = self.interval()
+        for c in pattern:
+            interval = interval.extend_right(c)
+            if not interval:
+                break
+        return interval
+
+    def count(self, pattern):
+        return len(self.search(pattern)) if pattern else 0
+
+    def query(self, pattern):
+        return self.search(pattern).locate() if pattern else []
+
+    def _extend(self, source, source_start, target_start, size, c):
+        """ Takes backward step with character c in source index and moves interval of the other index
+         past rows whose next symbol is smaller than c. Returns (source start, target start, size). """
+        code = source._f_column._codes.get(c)
+        if code is None or size == 0:
+            return 0, 0, 0
+        end = source_start + size
+        # codes 0..code, counted at interval start and end in one bulk lookup
+        codes = list(range(code + 1))
+        tallies = source._find_tallies([source_start] * len(codes) + [end] * len(codes), codes + codes)
+        counts = list(map(sub, tallies[len(codes):], tallies[:len(codes)]))
+        if counts[code] == 0:
+            return 0, 0, 0
+        new_source_start = source._f_column.code_first_occurrence(code) + tallies[code]
+        return new_source_start, target_start + sum(counts[:code]), counts[code]
+
+
+def create_bidirectional_fm_index(text, sa_factor, tally_factor, sa_builder=suffix_array_sais, backend="tally"):
+    """ Creates FM indexes of text and of its reverse. Suffix array of reversed text is only
+     sampled as sparsely as possible, since positions are always resolved in index of text. """
+    forward = create_fm_index(text, sa_factor, tally_factor, sa_builder, backend)
+    reverse = create_fm_index(text[::-1], len(text) + 1, tally_factor, sa_builder, backend)
+    return BidirectionalFMIndex(forward, reverse)
@@ -0,0 +1,65 @@
+from array import array
+from itertools import accumulate
+
+# number of bytes between two absolute rank samples
+rank_block_size = 64
+
+
+def buffer_size(buffer):
+    """ Returns number of bytes of data held by bytes, array or memoryview, not counting object header """
+    return memoryview(buffer).nbytes
+
+
+class BitVector:
+    """ Bits packed eight per byte, with number of set bits before every block of rank_block_size bytes """
+    def __init__(self, bits, block_ranks, length):
+        self.bits = bits
+        self.block_ranks = block_ranks
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        return self.bits[index >> 3] >> (index & 7) & 1
+
+    def memory_usage(self):
+        return buffer_size(self.bits) + buffer_size(self.block_ranks)
+
+    def rank(self, index):
+        """ Returns number of set bits in [0, index) """
+        byte_index = index >> 3
+        block = byte_index // rank_block_size
+        result = self.block_ranks[block]
+        block_start = block * rank_block_size
+        if block_start < byte_index:
+            result += int.from_bytes(self.bits[block_start:byte_index], 'little').bit_count()
+        if index & 7:
+            result += (self.bits[byte_index] & ((1 << (index & 7)) - 1)).bit_count()
+        return result
+
+
+def create_bit_vector(positions, length):
+    """ Creates bit vector of given length with bits set on given positions """
+    bits = bytearray((length + 7) // 8)
+    for i in positions:
+        bits[i >> 3] |= 1 << (i & 7)
+    return bit_vector_from_bytes(bytes(bits), length)
+
+
+def pack_bits(flags):
+    """ Returns bits of flags, a bytes object of zeros and ones, packed eight per byte.
+     Every eighth flag is shifted into place at once, through one integer per bit position. """
+    flags += bytes(-len(flags) % 8)
+    packed = 0
+    for shift in range(8):
+        packed |= int.from_bytes(flags[shift::8], 'little') << shift
+    return packed.to_bytes(len(flags) // 8, 'little')
+
+
+def bit_vector_from_bytes(bits, length):
+    """ Creates bit vector of given length over bits already packed eight per byte """
+    block_counts = (int.from_bytes(bits[i:i + rank_block_size], 'little').bit_count()
+                    for i in range(0, len(bits), rank_block_size))
+    block_ranks = array('I' if length < 2 ** 32 else 'Q', accumulate(block_counts, initial=0))
+    return BitVector(bits, block_ranks, length)
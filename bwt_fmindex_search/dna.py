@@ -0,0 +1,113 @@
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from itertools import accumulate, repeat
+
+# number of symbols packed two bits each, the rest are kept as exceptions
+packed_symbols = 4
+# two bit field value stored on exception positions
+exception_field = 0
+
+
+class PackedDNA:
+    """ Sequence of symbol codes with its four most frequent symbols packed two bits each, four per byte.
+     Positions of remaining symbols, such as N and terminal, are kept in one sorted array for access
+     and in one sorted array per symbol for rank, while packed sequence holds exception_field on them.
+     Counts of packed symbols are sampled every factor positions, and rank inside a block matches
+     all two bit fields of the block at once with integer operations and counts matches with popcount. """
+    def __init__(self, packed, length, slot_codes, code_slots, ranks, factor, rows, exceptions, exception_codes,
+                 code_exceptions):
+        self.packed = packed
+        self.length = length
+        self.slot_codes = slot_codes
+        self.code_slots = code_slots
+        self.ranks = ranks
+        self.factor = factor
+        self.rows = rows
+        self.exceptions = exceptions
+        self.exception_codes = exception_codes
+        self.code_exceptions = code_exceptions
+        # 01 in every two bit field of a block
+        self._low_bits = (4 ** factor - 1) // 3
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        i = bisect_left(self.exceptions, index)
+        if i < len(self.exceptions) and self.exceptions[i] == index:
+            return self.exception_codes[i]
+        return self.slot_codes[self.packed[index >> 2] >> ((index & 3) << 1) & 3]
+
+    def memory_usage(self):
+        return sum(memoryview(buffer).nbytes for buffer in
+                   [self.packed, self.ranks, self.exceptions, self.exception_codes] + list(self.code_exceptions.values()))
+
+    def rank(self, code, index):
+        """ Returns number of occurrences of symbol code in sequence[:index] """
+        slot = self.code_slots.get(code)
+        if slot is None:
+            positions = self.code_exceptions.get(code)
+            return bisect_left(positions, index) if positions is not None else 0
+        row = index // self.factor
+        start = row * self.factor
+        result = self.ranks[slot * self.rows + row]
+        if start < index:
+            fields = index - start
+            block = int.from_bytes(self.packed[start >> 2:(index + 3) >> 2], 'little')
+            low_bits = self._low_bits & ((1 << (fields << 1)) - 1)
+            # fields equal to slot become 00, then both of their bits are moved to the low bit and negated
+            difference = block ^ (low_bits * slot)
+            result += (~(difference | difference >> 1) & low_bits).bit_count()
+            if slot == exception_field:
+                result -= bisect_left(self.exceptions, index) - bisect_left(self.exceptions, start)
+        return result
+
+    def rank_many(self, indices, codes):
+        return list(map(self.rank, codes, indices))
+
+
+def create_packed_dna(codes, alphabet_size, factor):
+    """ Creates PackedDNA over sequence of integer codes smaller than alphabet_size.
+     Codes 1 and above are packed in order of frequency, code 0 (terminal) always is an exception.
+     Sampling factor is rounded up to a multiple of four, so every block starts on a byte. """
+    factor = -(-factor // 4) * 4
+    length = len(codes)
+    counts = Counter(codes)
+    slot_codes = sorted(sorted((code for code in counts if code != 0), key=lambda code: -counts[code])[:packed_symbols])
+    code_slots = {code: slot for slot, code in enumerate(slot_codes)}
+    slot_codes += [0] * (packed_symbols - len(slot_codes))
+    # every symbol as its slot, exceptions as packed_symbols so they are not counted as any slot
+    slot_table = bytes(code_slots.get(code, packed_symbols) for code in range(max(alphabet_size, 256)))
+    if isinstance(codes, bytes) and alphabet_size <= 256:
+        slots = codes.translate(slot_table)
+    else:
+        slots = bytes(map(slot_table.__getitem__, codes))
+
+    rows = (length + factor - 1) // factor + 1
+    typecode = 'I' if length < 2 ** 32 else 'Q'
+    ranks = array(typecode)
+    for slot in range(packed_symbols):
+        ranks.append(0)
+        ranks.extend(accumulate(map(slots.count, repeat(slot), range(0, length, factor),
+                                    range(factor, length + factor, factor))))
+
+    exceptions = array(typecode)
+    position = slots.find(packed_symbols)
+    while position != -1:
+        exceptions.append(position)
+        position = slots.find(packed_symbols, position + 1)
+    exception_codes = array('B' if alphabet_size <= 256 else typecode, map(codes.__getitem__, exceptions))
+    code_exceptions = {}
+    for position, code in zip(exceptions, exception_codes):
+        code_exceptions.setdefault(code, array(typecode)).append(position)
+
+    # four fields per byte, first position in the lowest two bits
+    slots = slots.replace(bytes([packed_symbols]), bytes([exception_field]))
+    slots += bytes(-length % 4)
+    packed = 0
+    for shift in range(4):
+        packed |= int.from_bytes(slots[shift::4], 'little') << (shift << 1)
+    packed = packed.to_bytes(len(slots) // 4, 'little')
+    return PackedDNA(packed, length, slot_codes, code_slots, ranks, factor, rows, exceptions, exception_codes,
+                     code_exceptions)
@@ -0,0 +1,247 @@
+import heapq
+import mmap
+import tempfile
+from functools import cmp_to_key, partial
+from itertools import groupby
+
+from index_file import *
+
+# estimated number of bytes taken by one suffix while its chunk is being sorted in memory
+bytes_per_sorted_suffix = 128
+# number of leading characters suffixes are sorted by before ties are compared in full
+sort_prefix_length = 16
+# characters str.splitlines splits on, removed from input like line breaks of text indexed in memory
+line_break_removal = dict.fromkeys(map(ord, '\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029'))
+# number of characters of two suffixes compared at once, when they are sorted and merged
+compare_window_size = 4096
+# estimated number of bytes taken by one character of input block while it is decoded and copied
+bytes_per_prepared_character = 16
+# number of items read or written at once by every stream
+stream_buffer_size = 1 << 16
+# number of equal shares of memory budget, one for buffers of merged runs, one for buffers of component streams,
+# and the rest for per stream overhead and copies of blocks being read or written
+stream_budget_shares = 4
+# largest number of sorted runs merged at once, so open files and merge buffers do not grow with text length
+max_merge_inputs = 16
+
+
+def prepare_text(input_path, text_path, block_size=stream_buffer_size * 16):
+    """ Copies text from input_path to text_path block by block, without line breaks and terminated with terminal_char.
+     Input is decoded and line breaks are removed the same way as by str.splitlines when text is indexed in memory,
+     and text is stored one character per byte, so characters above U+00FF are rejected.
+     Input is read block_size characters at a time.
+     Returns Counter with number of occurrences of every character of terminated text. """
+    counts = Counter()
+    with open(input_path, 'r', newline='') as input_file, open(text_path, 'wb') as text_file:
+        while True:
+            block = input_file.read(block_size)
+            if not block:
+                break
+            block = block.translate(line_break_removal)
+            if terminal_char in block:
+                raise ValueError("Text must not contain terminal character")
+            try:
+                text_file.write(block.encode('latin-1'))
+            except UnicodeEncodeError as e:
+                raise ValueError("External construction supports only characters up to U+00FF, found "
+                                 + repr(e.object[e.start])) from None
+            counts.update(block)
+        text_file.write(terminal_char.encode('latin-1'))
+    counts[terminal_char] = 1
+    return counts
+
+
+def compare_suffixes(text, first, second):
+    """ Compares suffixes of text starting on first and second position, window of compare_window_size
+     characters at a time, so memory taken by a comparison does not grow with common prefix of suffixes """
+    offset = 0
+    while True:
+        s1 = text[first + offset:first + offset + compare_window_size]
+        s2 = text[second + offset:second + offset + compare_window_size]
+        if s1 != s2:
+            return -1 if s1 < s2 else 1
+        if not s1:
+            return 0
+        offset += compare_window_size
+
+
+def sort_suffixes(text, positions):
+    """ Returns positions sorted by suffixes of text starting on them """
+    positions = sorted(positions, key=lambda i: text[i:i + sort_prefix_length])
+    result = []
+    for _, group in groupby(positions, key=lambda i: text[i:i + sort_prefix_length]):
+        group = list(group)
+        if len(group) > 1:
+            group.sort(key=cmp_to_key(partial(compare_suffixes, text)))
+        result.extend(group)
+    return result
+
+
+def read_items(path, typecode, buffer_size=stream_buffer_size):
+    """ Yields items of array stored in file on given path, reading buffer_size items at a time """
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            block = array(typecode)
+            try:
+                block.fromfile(f, buffer_size)
+            except EOFError:
+                yield from block
+                return
+            yield from block
+
+
+def read_chunks(path, block_size=stream_buffer_size * 16):
+    """ Yields raw bytes of file on given path, block_size bytes at a time """
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                return
+            yield block
+
+
+def write_sorted_chunks(text, chunk_size, directory):
+    """ Sorts suffixes of text in chunks of chunk_size consecutive positions.
+     Every sorted chunk is written to its own file in directory. Returns paths of chunk files. """
+    paths = []
+    typecode = index_typecode(len(text))
+    for start in range(0, len(text), chunk_size):
+        path = os.path.join(directory, "chunk" + str(len(paths)))
+        with open(path, 'wb') as f:
+            array(typecode, sort_suffixes(text, range(start, min(start + chunk_size, len(text))))).tofile(f)
+        paths.append(path)
+    return paths
+
+
+class ArrayStream:
+    """ Integer array written to file in blocks of buffer_size items """
+    def __init__(self, path, typecode, buffer_size=stream_buffer_size):
+        self.path = path
+        self.typecode = typecode
+        self.buffer_size = buffer_size
+        self.length = 0
+        self._buffer = array(typecode)
+        # items are written in whole blocks, so file needs no buffer of its own
+        self._file = open(path, 'wb', buffering=0)
+
+    def append(self, value):
+        self._buffer.append(value)
+        if len(self._buffer) == self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.length += len(self._buffer)
+        self._buffer.tofile(self._file)
+        self._buffer = array(self.typecode)
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def section(self):
+        return self.typecode, self.length, read_chunks(self.path, self.buffer_size * self._buffer.itemsize)
+
+
+def merge_runs(text, paths, typecode, buffer_size):
+    """ Returns iterator over suffixes of all sorted runs stored in paths, merged in sorted order.
+     Runs are merged max_merge_inputs at a time into longer runs on disk until at most max_merge_inputs are left,
+     and every run is read buffer_size items at a time. """
+    key = cmp_to_key(partial(compare_suffixes, text))
+    merge_pass = 0
+    while len(paths) > max_merge_inputs:
+        merged_paths = []
+        for i in range(0, len(paths), max_merge_inputs):
+            run = ArrayStream(paths[i] + "." + str(merge_pass), typecode, buffer_size)
+            for position in heapq.merge(*[read_items(path, typecode, buffer_size)
+                                          for path in paths[i:i + max_merge_inputs]], key=key):
+                run.append(position)
+            run.close()
+            for path in paths[i:i + max_merge_inputs]:
+                os.remove(path)
+            merged_paths.append(run.path)
+        paths = merged_paths
+        merge_pass += 1
+    return heapq.merge(*[read_items(path, typecode, buffer_size) for path in paths], key=key)
+
+
+def stream_index_components(text, suffixes, f_column, sa_factor, tally_factor, directory,
+                            buffer_size=stream_buffer_size):
+    """ Consumes suffix array positions in sorted order and streams BWT, SA sample and tally rows into files.
+     Every stream, one per alphabet symbol for tally rows and four more, buffers buffer_size items.
+     Returns index file sections keyed by section name. """
+    typecode = index_typecode(len(text))
+    alphabet = bytes(ord(c) for c in f_column.alphabet)
+    codes = bytes.maketrans(alphabet, bytes(range(len(alphabet))))
+    bwt = ArrayStream(os.path.join(directory, "bwt"), 'B', buffer_size)
+    marks = ArrayStream(os.path.join(directory, "sa_marks"), 'B', buffer_size)
+    block_ranks = ArrayStream(os.path.join(directory, "sa_block_ranks"), 'I' if len(text) < 2 ** 32 else 'Q',
+                              buffer_size)
+    values = ArrayStream(os.path.join(directory, "sa_values"), typecode, buffer_size)
+    tallies = [ArrayStream(os.path.join(directory, "tally" + str(code)), typecode, buffer_size)
+               for code in range(len(alphabet))]
+    counts = [0] * len(alphabet)
+    marks_byte = 0
+    for row, position in enumerate(suffixes):
+        if row % tally_factor == 0:
+            for code, tally in enumerate(tallies):
+                tally.append(counts[code])
+        if row % (rank_block_size * 8) == 0:
+            block_ranks.append(values.length + len(values._buffer))
+        code = codes[text[position - 1]] if position else 0
+        counts[code] += 1
+        bwt.append(code)
+        if position % sa_factor == 0:
+            marks_byte |= 1 << (row & 7)
+            values.append(position)
+        if row & 7 == 7:
+            marks.append(marks_byte)
+            marks_byte = 0
+    if len(text) & 7:
+        marks.append(marks_byte)
+    block_ranks.append(values.length + len(values._buffer))
+    for code, tally in enumerate(tallies):
+        tally.append(counts[code])
+    for stream in [bwt, marks, block_ranks, values] + tallies:
+        stream.close()
+
+    tally_chunks = (chunk for tally in tallies for chunk in tally.section()[2])
+    return {
+        "bwt": bwt.section(),
+        "tally": (typecode, sum(tally.length for tally in tallies), tally_chunks),
+        "sa_marks": marks.section(),
+        "sa_block_ranks": block_ranks.section(),
+        "sa_values": values.section(),
+    }
+
+
+def build_index_file(input_path, index_path, sa_factor, tally_factor, memory_budget):
+    """ Builds index file of text in input_path without keeping text, suffix array or BWT in memory.
+     Suffixes are sorted in chunks that fit in memory_budget bytes, written to temporary files and merged
+     in passes of at most max_merge_inputs runs, while BWT, SA sample and tally rows are streamed into
+     temporary files and finally into index file. """
+    chunk_size = max(1, memory_budget // bytes_per_sorted_suffix)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(index_path))) as directory:
+        text_path = os.path.join(directory, "text")
+        counts = prepare_text(input_path, text_path, max(1, memory_budget // bytes_per_prepared_character))
+        f_column = FColumn(counts, calculate_first_occurrences(counts))
+        with open(text_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as text:
+            chunk_paths = write_sorted_chunks(text, chunk_size, directory)
+            typecode = index_typecode(len(text))
+            itemsize = array(typecode).itemsize
+            # last merge runs together with component streams, so buffers of each side get their share of the budget,
+            # split equally among merged runs and the run being written, or among streams of all components
+            merge_buffer_size = max(1, memory_budget // (stream_budget_shares * (max_merge_inputs + 1) * itemsize))
+            component_buffer_size = max(1, memory_budget // (stream_budget_shares * (len(f_column.alphabet) + 4) *
+                                                             itemsize))
+            suffixes = merge_runs(text, chunk_paths, typecode, merge_buffer_size)
+            sections = stream_index_components(text, suffixes, f_column, sa_factor, tally_factor, directory,
+                                               component_buffer_size)
+            header = {
+                "length": len(text),
+                "alphabet": f_column.alphabet,
+                "counts": [counts[c] for c in f_column.alphabet],
+                "tally_factor": tally_factor,
+                "tally_rows": (len(text) + tally_factor - 1) // tally_factor + 1,
+                "sa_factor": sa_factor,
+            }
+            write_index_file(index_path, header, sections)
@@ -0,0 +1,62 @@
+from array import array
+from bisect import bisect_right
+
+# Separates records in index input. It must not occur in any record, so no match can span two records.
+record_separator = '\1'
+
+
+class RecordTable:
+    """ Names and start offsets of records in index input """
+    def __init__(self, names, starts):
+        self.names = names
+        self.starts = starts
+
+    def __len__(self):
+        return len(self.names)
+
+    def locate(self, position):
+        """ Returns (record_id, offset) of given position in index input """
+        record_id = bisect_right(self.starts, position) - 1
+        return record_id, position - self.starts[record_id]
+
+
+def read_sequences(file, separator=record_separator):
+    """ Reads all FASTA or FASTQ records from file opened in binary mode, in a single pass.
+    Sequences are upper-cased and appended to one byte buffer with separator between records,
+    so memory used besides the result does not depend on number of lines.
+    Returns index input and RecordTable of its records, named by the first word of their headers. """
+    text = bytearray()
+    names = []
+    starts = array('Q')
+    separator = separator.encode('latin-1')
+
+    def start_record(header):
+        # record is named by the first word of its header
+        if names:
+            text.extend(separator)
+        names.append(header.split(maxsplit=1)[0].decode('latin-1') if header.strip() else '')
+        starts.append(len(text))
+
+    lines = iter(file)
+    for line in lines:
+        line = line.rstrip()
+        if line.startswith(b'>'):
+            start_record(line[1:])
+        elif line.startswith(b'@'):
+            # FASTQ record, quality lines may start with '@' so they are skipped by length
+            start_record(line[1:])
+            sequence_length = 0
+            for line in lines:
+                line = line.rstrip()
+                if line.startswith(b'+'):
+                    break
+                text.extend(line.upper())
+                sequence_length += len(line)
+            quality_length = 0
+            while quality_length < sequence_length:
+                quality_length += len(next(lines).rstrip())
+        elif line:
+            if not names:
+                start_record(b'')
+            text.extend(line.upper())
+    return text.decode('latin-1'), RecordTable(names, starts)
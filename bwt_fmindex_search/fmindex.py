@@ -1,8 +1,10 @@
 import argparse
+import multiprocessing
 import os
 from collections import Counter
 
 from sa import *
+from util import parallel_map_chunks, positive_int
 
 # Using \0 instead of $ for terminal character because latter would not work with strings containing spaces
 terminal_char = '\0'
@@ -96,9 +98,27 @@ def create_f_column(text):
     return FColumn(count, first_occurrence)
 
 
-def create_fm_index(text):
+# FM index inherited by forked worker processes of query_in_parallel
+shared_fm_index = None
+
+
+def query_chunk(patterns):
+    return [shared_fm_index.query(pattern) for pattern in patterns]
+
+
+def query_in_parallel(fm_index, patterns, workers):
+    """ Searches patterns on a pool of forked worker processes.
+     Workers share pages of fm_index with parent process instead of receiving a pickled copy. """
+    if "fork" not in multiprocessing.get_all_start_methods():
+        raise RuntimeError("Parallel search needs fork start method, which is not available on this platform")
+    global shared_fm_index
+    shared_fm_index = fm_index
+    return parallel_map_chunks(query_chunk, patterns, workers, context="fork")
+
+
+def create_fm_index(text, sa_builder=suffix_array_sais):
     t = terminate_string(text)
-    sa = suffix_array_manber_myers(t)
+    sa = sa_builder(t)
     bwt = bw_transform(t, sa)
     ranks = calculate_ranks(bwt)
     f_column = create_f_column(t)
@@ -112,11 +132,19 @@ if __name__ == "__main__":
     parser.add_argument("-p", "--patterns", required=True, help="Path to patterns file.")
     parser.add_argument("-r", "--results", required=False,
                         help="Path to output results file. If omitted, results will be printed to standard output.")
+    parser.add_argument("--sa_algorithm", choices=sorted(sa_builders), default="sais", required=False,
+                        help="Suffix array construction algorithm. If omitted, linear time SA-IS will be used.")
+    parser.add_argument("--workers", type=positive_int, default=1, required=False,
+                        help="Number of worker processes searching patterns in parallel. If omitted, patterns are searched in a single process.")
     args = vars(parser.parse_args())
+    if args["workers"] > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        parser.error("--workers needs fork start method, which is not available on this platform")
 
     text_path = args["text"]
     patterns_path = args["patterns"]
     results_path = args["results"]
+    sa_builder = sa_builders[args["sa_algorithm"]]
+    workers = args["workers"]
 
     # read input files
     if not os.path.isfile(text_path):
@@ -130,8 +158,11 @@ if __name__ == "__main__":
             patterns = f.read().splitlines()
 
     # search for patterns
-    fm_index = create_fm_index(text)
-    results = [fm_index.query(pattern) for pattern in patterns]
+    fm_index = create_fm_index(text, sa_builder)
+    if workers > 1:
+        results = query_in_parallel(fm_index, patterns, workers)
+    else:
+        results = [fm_index.query(pattern) for pattern in patterns]
 
     # write results
     if results_path:
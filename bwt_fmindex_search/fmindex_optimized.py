@@ -1,18 +1,31 @@
 import argparse
 import os
+import sys
+from array import array
+from bisect import bisect_left
 from collections import Counter
+from heapq import nsmallest
+from itertools import accumulate, compress, islice, repeat
+from operator import add, floordiv, itemgetter, mod, mul, not_, sub
 
+from bitvector import *
+from dna import *
+from fasta import *
 from sa import *
+from util import non_negative_int, positive_int
+from wavelet import *
 
 # Using \0 instead of $ for terminal character because latter would not work with strings containing spaces
 terminal_char = '\0'
 
+# Number of suffix array rows that locate resolves together
+locate_batch_size = 256
 
-def positive_int(value):
-    ivalue = int(value)
-    if ivalue <= 0:
-        raise argparse.ArgumentTypeError("%s is an invalid positive int value" % value)
-    return ivalue
+# Tally factors below this one are sampled from running counts of a symbol instead of counted block by block
+cumulative_tally_limit = 16
+
+# Block sizes below this one keep relative block counts in bytes, larger ones in 16 bit integers
+byte_block_counts_limit = 64
 
 
 def bw_transform(text, sa):
@@ -37,12 +50,54 @@ def terminate_string(s):
     return s if s[-1:] == terminal_char else s + terminal_char
 
 
-def round_down(n, base):
-    return n // base * base
+def index_typecode(n):
+    """ Returns smallest array typecode able to hold indices into a sequence of length n """
+    return 'I' if n < 2 ** 32 else 'Q'
+
+
+def encode_bwt(bwt, f_column):
+    """ Returns BWT with every character replaced by its code in f_column alphabet.
+     Result is bytes object (one byte per symbol) if alphabet fits in a byte, otherwise an integer array. """
+    if len(f_column.alphabet) <= 256:
+        return bwt.translate({ord(c): code for code, c in enumerate(f_column.alphabet)}).encode('latin-1')
+    return array(index_typecode(len(f_column.alphabet)), f_column.encode(bwt))
+
+
+def create_encoded_bwt(text, sa, f_column):
+    """ Returns encode_bwt(bw_transform(text, sa), f_column) of terminated text.
+     Text is encoded once, rotated by one symbol so its position p holds symbol preceding suffix p,
+     and BWT is gathered from it in suffix array order. """
+    codes = encode_bwt(text, f_column)
+    rotated = codes[-1:] + codes[:-1]
+    if len(sa) == 1:
+        return rotated
+    # single itemgetter call gathers all rows in C, it returns a tuple for two or more rows
+    preceding = itemgetter(*sa)(rotated)
+    return bytes(preceding) if isinstance(codes, bytes) else array(codes.typecode, preceding)
+
+
+def sampled_rows(sa, factor):
+    """ Returns flags of suffix array rows whose value is divisible by factor, as bytes of zeros and ones """
+    if factor == 1:
+        return bytes([1]) * len(sa)
+    return bytes(map(not_, map(mod, sa, repeat(factor))))
+
+
+def count_symbol(bwt, code, start, end):
+    """ Returns number of occurrences of symbol code in bwt[start:end] """
+    if isinstance(bwt, bytes):
+        return bwt.count(code, start, end)
+    block = bwt[start:end]
+    if isinstance(block, memoryview):
+        block = block.tobytes() if block.itemsize == 1 else block.tolist()
+    return block.count(code)
 
 
-def round_up(n, base):
-    return (n + base - 1) // base * base
+def count_symbols(bwt, codes, starts, ends):
+    """ Returns iterator over number of occurrences of every symbol code in corresponding bwt[start:end] """
+    if isinstance(bwt, bytes):
+        return map(bwt.count, codes, starts, ends)
+    return map(count_symbol, repeat(bwt), codes, starts, ends)
 
 
 def calculate_first_occurrences(counts):
@@ -55,15 +110,182 @@ def calculate_first_occurrences(counts):
 
 
 class Tally:
-    def __init__(self, ranks, factor):
+    """ Every factor-th rank of each symbol, stored as one contiguous (alphabet x rows) array.
+     Row k of a symbol holds the number of its occurrences in bwt[:k * factor].
+     Ranks between rows are counted in bwt. """
+    def __init__(self, bwt, ranks, factor, rows):
+        self.bwt = bwt
         self.ranks = ranks
         self.factor = factor
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.bwt)
+
+    def __getitem__(self, index):
+        return self.bwt[index]
+
+    def memory_usage(self):
+        """ Returns bytes taken by tally rows. BWT they count in is not included. """
+        return buffer_size(self.ranks)
+
+    def rank(self, code, index):
+        """ Returns number of occurrences of symbol code in bwt[:index],
+         counting from the closer of two neighbouring tally rows """
+        row, offset = divmod(index, self.factor)
+        ranks_offset = code * self.rows + row
+        if offset == 0:
+            return self.ranks[ranks_offset]
+        next_index = min(index - offset + self.factor, len(self.bwt))
+        if offset <= next_index - index:
+            return self.ranks[ranks_offset] + count_symbol(self.bwt, code, index - offset, index)
+        else:
+            return self.ranks[ranks_offset + 1] - count_symbol(self.bwt, code, index, next_index)
+
+    def rank_many(self, indices, codes):
+        """ Returns list with number of occurrences of every symbol code in bwt[:index] of corresponding index.
+         All lookups count forward from the preceding tally row and are done in bulk. """
+        rows = list(map(floordiv, indices, repeat(self.factor)))
+        offsets = map(add, map(mul, codes, repeat(self.rows)), rows)
+        in_block = count_symbols(self.bwt, codes, map(mul, rows, repeat(self.factor)), indices)
+        return list(map(add, map(self.ranks.__getitem__, offsets), in_block))
+
+
+class RankDirectory:
+    """ Two-level directory of ranks of each symbol, stored as contiguous (alphabet x rows) arrays.
+     Superblock row k of a symbol holds the number of its occurrences in bwt[:k * blocks_per_superblock * block_size]
+     and block row k holds the number of its occurrences in bwt[:k * block_size] minus their superblock row.
+     Block counts are smaller than superblock length, so they fit in narrow integers, and ranks between
+     block rows are counted in bwt from the closer of two neighbouring block rows. """
+    def __init__(self, bwt, superblocks, blocks, block_size, blocks_per_superblock, superblock_rows, block_rows):
+        self.bwt = bwt
+        self.superblocks = superblocks
+        self.blocks = blocks
+        self.block_size = block_size
+        self.blocks_per_superblock = blocks_per_superblock
+        self.superblock_rows = superblock_rows
+        self.block_rows = block_rows
+
+    def __len__(self):
+        return len(self.bwt)
+
+    def __getitem__(self, index):
+        return self.bwt[index]
+
+    def memory_usage(self):
+        """ Returns bytes taken by directory and BWT it counts in """
+        return buffer_size(self.bwt) + buffer_size(self.superblocks) + buffer_size(self.blocks)
+
+    def _block_rank(self, code, block):
+        """ Returns number of occurrences of symbol code in bwt[:block * block_size] """
+        return self.superblocks[code * self.superblock_rows + block // self.blocks_per_superblock] + \
+            self.blocks[code * self.block_rows + block]
+
+    def rank(self, code, index):
+        """ Returns number of occurrences of symbol code in bwt[:index] """
+        block, offset = divmod(index, self.block_size)
+        if offset == 0:
+            return self._block_rank(code, block)
+        next_index = min(index - offset + self.block_size, len(self.bwt))
+        if offset <= next_index - index:
+            return self._block_rank(code, block) + count_symbol(self.bwt, code, index - offset, index)
+        else:
+            return self._block_rank(code, block + 1) - count_symbol(self.bwt, code, index, next_index)
+
+    def rank_many(self, indices, codes):
+        """ Returns list with number of occurrences of every symbol code in bwt[:index] of corresponding index.
+         All lookups count forward from the preceding block row and are done in bulk. """
+        blocks = list(map(floordiv, indices, repeat(self.block_size)))
+        superblock_offsets = map(add, map(mul, codes, repeat(self.superblock_rows)),
+                                 map(floordiv, blocks, repeat(self.blocks_per_superblock)))
+        block_offsets = map(add, map(mul, codes, repeat(self.block_rows)), blocks)
+        in_block = count_symbols(self.bwt, codes, map(mul, blocks, repeat(self.block_size)), indices)
+        return list(map(add, map(add, map(self.superblocks.__getitem__, superblock_offsets),
+                                 map(self.blocks.__getitem__, block_offsets)), in_block))
+
+
+class SASample:
+    """ Suffix array values of marked rows, stored in row order """
+    def __init__(self, marks, values, factor):
+        self.marks = marks
+        self.values = values
+        self.factor = factor
+
+    def memory_usage(self):
+        return self.marks.memory_usage() + buffer_size(self.values)
+
+    def get(self, index, default=None):
+        if self.marks[index]:
+            return self.values[self.marks.rank(index)]
+        return default
+
+
+class ISASample:
+    """ Suffix array rows of every factor-th text position, stored in position order,
+     and rows of every terminal character position, stored in terminals order.
+     Text is extracted by LF walks back from sampled positions, and walks never have to step over
+     a terminal, because its position is sampled and LF across documents may not follow text order. """
+    def __init__(self, values, terminals, terminal_values, factor):
+        self.values = values
+        self.terminals = terminals
+        self.terminal_values = terminal_values
+        self.factor = factor
+
+    def memory_usage(self):
+        return buffer_size(self.values) + buffer_size(self.terminals) + buffer_size(self.terminal_values)
+
+    def next_sample(self, position):
+        """ Returns (sampled position, its row) of the first sampled position not smaller than position,
+         which must not be larger than position of the last terminal """
+        i = bisect_left(self.terminals, position)
+        sampled = -(-position // self.factor) * self.factor
+        if self.terminals[i] <= sampled:
+            return self.terminals[i], self.terminal_values[i]
+        return sampled, self.values[sampled // self.factor]
+
+
+class KmerTable:
+    """ Suffix array intervals of every string of at most length characters over text alphabet without terminal.
+     Strings are numbered as base (alphabet size - 1) integers, first character most significant,
+     and intervals of strings of one length are stored one after another starting from offsets[length]. """
+    def __init__(self, length, base, offsets, starts, ends):
+        self.length = length
+        self.base = base
+        self.offsets = offsets
+        self.starts = starts
+        self.ends = ends
+
+    def memory_usage(self):
+        return buffer_size(self.starts) + buffer_size(self.ends) + sys.getsizeof(self.offsets)
+
+    def lookup(self, codes):
+        """ Returns suffix array interval (start, end) of string of given symbol codes, (0, 0) if it does not occur,
+         or None if string is longer than length or contains terminal """
+        if not 0 < len(codes) <= self.length:
+            return None
+        value = 0
+        for code in codes:
+            if code == 0:
+                return None
+            value = value * self.base + code - 1
+        index = self.offsets[len(codes)] + value
+        start_index, end_index = self.starts[index], self.ends[index]
+        return (start_index, end_index) if start_index < end_index else (0, 0)
 
 
 class FColumn:
     def __init__(self, counts, zero_rank_indices):
         self._counts = counts
         self._zero_rank_indices = zero_rank_indices
+        self.alphabet = sorted(zero_rank_indices)
+        self._codes = {c: code for code, c in enumerate(self.alphabet)}
+        self.code_first_occurrences = [zero_rank_indices[c] for c in self.alphabet]
+        self.code_counts = [counts[c] for c in self.alphabet]
+
+    def memory_usage(self):
+        """ Returns bytes taken by containers of per symbol values, which share their alphabet sized items """
+        return sum(map(sys.getsizeof, [self._counts, self._zero_rank_indices, self.alphabet, self._codes,
+                                       self.code_first_occurrences, self.code_counts]))
 
     def char_range(self, c):
         return self.first_occurrence(c), self.first_occurrence(c) + self._counts[c]
@@ -71,81 +293,370 @@ class FColumn:
     def first_occurrence(self, c):
         return self._zero_rank_indices.get(c, 0)
 
+    def code_range(self, code):
+        return self.code_first_occurrence(code), self.code_first_occurrence(code) + self.code_counts[code]
+
+    def code_first_occurrence(self, code):
+        return self.code_first_occurrences[code]
+
+    def encode(self, s):
+        """ Returns list of codes of characters in s or None if some of them does not occur in text """
+        codes = self._codes
+        try:
+            return [codes[c] for c in s]
+        except KeyError:
+            return None
+
 
 class FMIndex:
-    def __init__(self, bwt, sa_sample, tally, f_column):
+    def __init__(self, bwt, sa_sample, tally, f_column, kmer_table=None, isa_sample=None):
         self._bwt = bwt
         self._sa_sample = sa_sample
         self._tally = tally
         self._f_column = f_column
+        self._kmer_table = kmer_table
+        self._isa_sample = isa_sample
 
     def query(self, pattern):
-        reverse_pattern = pattern[::-1]
-        start_index, end_index = self._f_column.char_range(reverse_pattern[0])
-        if start_index == end_index:
+        start_index, end_index = self._backward_search(pattern)
+        return self._find_suffixes(range(start_index, end_index))
+
+    def memory_report(self):
+        """ Returns bytes of data taken by every component of index and their total.
+         Sizes are taken from buffer lengths, so report costs the same for any text length.
+         If rank backend answers symbol queries by itself, BWT is counted in tally. """
+        report = {
+            "bwt": 0 if self._bwt is self._tally else buffer_size(self._bwt),
+            "tally": self._tally.memory_usage(),
+            "sa_sample": self._sa_sample.memory_usage(),
+            "f_column": self._f_column.memory_usage(),
+            "kmer_table": self._kmer_table.memory_usage() if self._kmer_table is not None else 0,
+            "isa_sample": self._isa_sample.memory_usage() if self._isa_sample is not None else 0,
+        }
+        report["total"] = sum(report.values())
+        return report
+
+    def count(self, pattern):
+        """ Returns number of occurrences of pattern without locating any of them """
+        start_index, end_index = self._backward_search(pattern)
+        return end_index - start_index
+
+    def locate(self, pattern, limit=None):
+        """ Yields positions of pattern occurrences in suffix array order.
+         Every position is resolved only when requested, so callers may stop early. """
+        start_index, end_index = self._backward_search(pattern)
+        if limit is not None:
+            end_index = min(end_index, start_index + limit)
+        for batch_start in range(start_index, end_index, locate_batch_size):
+            yield from self._find_suffixes(range(batch_start, min(batch_start + locate_batch_size, end_index)))
+
+    def locate_sorted(self, pattern, limit=None):
+        """ Returns positions of pattern occurrences in increasing order.
+         If limit is given, only that many smallest positions are returned. """
+        if limit is None:
+            return sorted(self.locate(pattern))
+        return nsmallest(limit, self.locate(pattern))
+
+    def extract(self, start, length):
+        """ Returns text[start:start + length] reconstructed from index, without final terminal """
+        return self.extract_many([(start, length)])[0]
+
+    def snippet(self, position, before, after):
+        """ Returns text around position, from before characters ahead of it to after characters past it.
+         Snippet does not reach over terminals, so it stays within document containing position. """
+        return self.snippets([position], before, after)[0]
+
+    def snippets(self, positions, before, after):
+        """ Returns snippet around every position, extracted together """
+        starts = [max(0, position - before) for position in positions]
+        texts = self.extract_many([(start, position + after - start) for start, position in zip(starts, positions)])
+        snippets = []
+        for text, start, position in zip(texts, starts, positions):
+            offset = position - start
+            end = text.find(terminal_char, offset)
+            snippets.append(text[text.rfind(terminal_char, 0, offset) + 1:end if end != -1 else len(text)])
+        return snippets
+
+    def extract_many(self, ranges):
+        """ Returns text[start:start + length] of every (start, length) range, in order of ranges.
+         Ranges are cut at sampled positions into pieces, and every piece is read by LF walk back from
+         the sampled position following it. Pieces read from the same sampled position share one walk
+         that goes as far back as the longest of them needs, and all walks take LF steps together. """
+        if self._isa_sample is None:
+            raise ValueError("Index has no inverse suffix array sample, build it with isa_factor")
+        text_length = len(self._bwt) - 1
+        # pieces (start, end, sampled position) of every range and the farthest start of walk from every sample
+        range_pieces = []
+        walk_starts = {}
+        walk_rows = {}
+        for start, length in ranges:
+            start, end = min(max(start, 0), text_length), min(start + length, text_length)
+            pieces = []
+            while start < end:
+                sampled, row = self._isa_sample.next_sample(start + 1)
+                pieces.append((start, min(sampled, end), sampled))
+                walk_starts[sampled] = min(walk_starts.get(sampled, sampled), start)
+                walk_rows[sampled] = row
+                start = sampled
+            range_pieces.append(pieces)
+
+        samples = list(walk_starts)
+        rows = [walk_rows[sampled] for sampled in samples]
+        steps = [sampled - walk_starts[sampled] for sampled in samples]
+        read = [[] for _ in samples]
+        pending = range(len(samples))
+        first_occurrences = self._f_column.code_first_occurrences
+        step = 1
+        while pending:
+            codes = list(map(self._bwt.__getitem__, rows))
+            for i, code in zip(pending, codes):
+                read[i].append(code)
+            unfinished = [j for j, i in enumerate(pending) if steps[i] > step]
+            pending = [pending[j] for j in unfinished]
+            rows = [rows[j] for j in unfinished]
+            codes = [codes[j] for j in unfinished]
+            rows = list(map(add, map(first_occurrences.__getitem__, codes), self._find_tallies(rows, codes)))
+            step += 1
+
+        alphabet = self._f_column.alphabet
+        walk_texts = {sampled: ''.join(map(alphabet.__getitem__, reversed(codes))) for sampled, codes in zip(samples, read)}
+        return [''.join(walk_texts[sampled][start - walk_starts[sampled]:end - walk_starts[sampled]]
+                        for start, end, sampled in pieces) for pieces in range_pieces]
+
+    def query_many(self, patterns):
+        """ Returns suffix array interval (start, end) of every pattern, in order of patterns.
+         Interval (0, 0) means that pattern does not occur in text.
+         Patterns are sorted by length and all of them that are still long enough are advanced
+         by one backward step at a time, with tally lookups of a whole step done in bulk. """
+        all_codes = [self._f_column.encode(pattern[::-1]) for pattern in patterns]
+        order = sorted((i for i, codes in enumerate(all_codes) if codes), key=lambda i: len(all_codes[i]), reverse=True)
+        reverse_codes = [all_codes[i] for i in order]
+        lengths = [len(codes) for codes in reverse_codes]
+        first_occurrences = self._f_column.code_first_occurrences
+        first_codes = [codes[0] for codes in reverse_codes]
+        starts = list(map(first_occurrences.__getitem__, first_codes))
+        ends = list(map(add, starts, map(self._f_column.code_counts.__getitem__, first_codes)))
+        active = len(order)
+        step = 1
+        while True:
+            while active and lengths[active - 1] <= step:
+                active -= 1
+            if not active:
+                break
+            codes = [c[step] for c in reverse_codes[:active]]
+            tallies = self._find_tallies(starts[:active] + ends[:active], codes + codes)
+            first = list(map(first_occurrences.__getitem__, codes))
+            starts[:active] = map(add, first, tallies[:active])
+            ends[:active] = map(add, first, tallies[active:])
+            step += 1
+        intervals = [(0, 0)] * len(patterns)
+        for i, start_index, end_index in zip(order, starts, ends):
+            if start_index < end_index:
+                intervals[i] = (start_index, end_index)
+        return intervals
+
+    def query_approx(self, pattern, max_mismatches, max_edits=None):
+        """ Returns suffix array intervals (start, end, differences) of rows prefixed by strings that differ
+         from pattern in at most max_mismatches substituted characters, ordered by differences.
+         If max_edits is given, inserted and deleted characters are allowed as well and at most max_edits
+         differences of all kinds are made. Every interval is reported once, with its smallest number of differences.
+         Search backtracks over backward steps and prunes branches by lower bounds of _lower_bounds. """
+        codes = [self._f_column._codes.get(c, -1) for c in pattern]
+        if not codes:
             return []
-        for c in reverse_pattern[1:]:
-            first_rank, count = self._find_preceders(start_index, end_index, c)
+        max_differences = max_mismatches if max_edits is None else max_edits
+        lower_bounds = self._lower_bounds(codes)
+        alphabet_codes = range(1, len(self._f_column.alphabet))
+        found = {}
+        # (next pattern index, interval start, interval end, mismatches, differences)
+        stack = [(len(codes) - 1, 0, len(self._bwt), 0, 0)]
+        while stack:
+            i, start_index, end_index, mismatches, differences = stack.pop()
+            if i < 0:
+                # whole pattern deleted matches empty string, whose interval holds terminal row as well
+                if end_index - start_index == len(self._bwt):
+                    continue
+                if differences < found.get((start_index, end_index), max_differences + 1):
+                    found[(start_index, end_index)] = differences
+                continue
+            if differences + lower_bounds[i] > max_differences:
+                continue
+            if max_edits is not None and differences < max_edits:
+                # pattern character missing from text
+                stack.append((i - 1, start_index, end_index, mismatches, differences + 1))
+            for code in alphabet_codes:
+                first_rank, count = self._find_preceders(start_index, end_index, code)
+                if count == 0:
+                    continue
+                new_start_index = self._f_column.code_first_occurrence(code) + first_rank
+                if code == codes[i]:
+                    stack.append((i - 1, new_start_index, new_start_index + count, mismatches, differences))
+                elif mismatches < max_mismatches and differences < max_differences:
+                    stack.append((i - 1, new_start_index, new_start_index + count, mismatches + 1, differences + 1))
+                if max_edits is not None and differences < max_edits and end_index - start_index < len(self._bwt):
+                    # text character missing from pattern, never after its last character as that only narrows interval
+                    stack.append((i, new_start_index, new_start_index + count, mismatches, differences + 1))
+        return sorted(((start_index, end_index, differences) for (start_index, end_index), differences in found.items()),
+                      key=lambda interval: (interval[2], interval[0]))
+
+    def _lower_bounds(self, codes):
+        """ Returns list whose i-th item is lower bound of differences needed to match codes[:i + 1].
+         Shortest suffix of codes[:i + 1] that does not occur in text needs at least one difference,
+         and the rest before it needs at least as many as its own bound. """
+        lower_bounds = []
+        for i in range(len(codes)):
+            start_index, end_index = 0, len(self._bwt)
+            j = i
+            while j >= 0 and codes[j] >= 0:
+                first_rank, count = self._find_preceders(start_index, end_index, codes[j])
+                if count == 0:
+                    break
+                start_index = self._f_column.code_first_occurrence(codes[j]) + first_rank
+                end_index = start_index + count
+                j -= 1
+            if j < 0:
+                lower_bounds.append(0)
+            else:
+                lower_bounds.append(1 + (lower_bounds[j - 1] if j > 0 else 0))
+        return lower_bounds
+
+    def _backward_search(self, pattern):
+        """ Returns suffix array interval (start, end) of rows prefixed by pattern.
+         If index has k-mer table, search starts from interval of the last k characters of pattern. """
+        reverse_codes = self._f_column.encode(pattern[::-1])
+        if not reverse_codes:
+            return 0, 0
+        interval = None
+        if self._kmer_table is not None:
+            skipped = min(len(reverse_codes), self._kmer_table.length)
+            interval = self._kmer_table.lookup(reverse_codes[skipped - 1::-1])
+        if interval is None:
+            skipped = 1
+            interval = self._f_column.code_range(reverse_codes[0])
+        start_index, end_index = interval
+        if start_index == end_index:
+            return 0, 0
+        for code in reverse_codes[skipped:]:
+            first_rank, count = self._find_preceders(start_index, end_index, code)
             if count == 0:
-                return []
+                return 0, 0
             else:
-                start_index = self._f_column.first_occurrence(c) + first_rank
+                start_index = self._f_column.code_first_occurrence(code) + first_rank
                 end_index = start_index + count
-        return [self._find_suffix(i) for i in range(start_index, end_index)]
+        return start_index, end_index
 
-    def _find_preceders(self, start_index, end_index, c):
-        first_tally = self._find_tally(start_index - 1, c)
-        last_tally = self._find_tally(end_index - 1, c)
+    def _find_preceders(self, start_index, end_index, code):
+        first_tally = self._find_tally(start_index, code)
+        last_tally = self._find_tally(end_index, code)
         return first_tally, last_tally - first_tally
 
-    def _find_tally(self, index, c):
-        if not self._tally.ranks[c]:
-            return -1
-        if index % self._tally.factor == 0:
-            return self._tally.ranks[c][index // self._tally.factor]
-        else:
-            count_back = index % self._tally.factor <= self._tally.factor // 2
-            sub_bwt = self._bwt[round_down(index, self._tally.factor) + 1: index + 1] if count_back else self._bwt[index + 1: min(len(self._bwt), round_up(index, self._tally.factor) + 1)]
-            if count_back:
-                return self._tally.ranks[c][index // self._tally.factor] + sub_bwt.count(c)
-            else:
-                return self._tally.ranks[c][index // self._tally.factor + 1] - sub_bwt.count(c)
+    def _find_tally(self, index, code):
+        """ Returns number of occurrences of symbol code in bwt[:index] """
+        return self._tally.rank(code, index)
+
+    def _find_tallies(self, indices, codes):
+        """ Returns list with number of occurrences of every symbol code in bwt[:index] of corresponding index """
+        return self._tally.rank_many(indices, codes)
 
     def _find_suffix(self, index):
+        steps = 0
         suffix = self._sa_sample.get(index, None)
-        if suffix is not None:
-            return suffix
+        while suffix is None:
+            code = self._bwt[index]
+            index = self._f_column.code_first_occurrence(code) + self._find_tally(index, code)
+            steps += 1
+            suffix = self._sa_sample.get(index, None)
+        return suffix + steps
+
+    def _find_suffixes(self, rows):
+        """ Returns suffix array values of given rows.
+         All unresolved rows take LF steps together and each row is dropped as soon as it lands on a sampled row. """
+        suffixes = [None] * len(rows)
+        pending = range(len(rows))
+        steps = 0
+        first_occurrences = self._f_column.code_first_occurrences
+        while True:
+            unresolved = []
+            unresolved_rows = []
+            for i, row in zip(pending, rows):
+                suffix = self._sa_sample.get(row, None)
+                if suffix is None:
+                    unresolved.append(i)
+                    unresolved_rows.append(row)
+                else:
+                    suffixes[i] = suffix + steps
+            if not unresolved:
+                return suffixes
+            codes = list(map(self._bwt.__getitem__, unresolved_rows))
+            tallies = self._find_tallies(unresolved_rows, codes)
+            rows = list(map(add, map(first_occurrences.__getitem__, codes), tallies))
+            pending = unresolved
+            steps += 1
+
+
+def create_ranks_tally(bwt, tally_factor, alphabet_size):
+    """ Creates tally matrix containing only every tally_factor-th rank of a character.
+     Ranks of all characters are laid out one after another in a single integer array. """
+    rows = (len(bwt) + tally_factor - 1) // tally_factor + 1
+    tally = array(index_typecode(len(bwt)))
+    last_block = len(bwt) - len(bwt) % tally_factor
+    for code in range(alphabet_size):
+        tally.append(0)
+        if isinstance(bwt, bytes) and tally_factor < cumulative_tally_limit:
+            # running count of symbol over its occurrence flags, taken at the end of every full block
+            table = bytearray(256)
+            table[code] = 1
+            flags = bwt.translate(table)
+            tally.extend(islice(accumulate(flags), tally_factor - 1, None, tally_factor))
+            if last_block < len(bwt):
+                tally.append(tally[-1] + flags.count(1, last_block))
         else:
-            rank = self._find_tally(index, self._bwt[index]) - 1
-            return 1 + self._find_suffix(self._f_column.first_occurrence(self._bwt[index]) + rank)
-
-
-def create_ranks_tally(bwt, tally_factor):
-    """ Creates tally matrix containing only every tally_factor-th rank of a character"""
-    count = Counter()
-    tally = defaultdict(list)
-    for i in range(0, len(bwt)):
-        c = bwt[i]
-        count[c] += 1
-        if i % tally_factor == 0:
-            for k, v in count.items():
-                if not tally[k]:
-                    tally[k].extend([0] * (i // tally_factor))
-                tally[k].append(v)
-    # for search simplicity add additional tally row
-    for k, v in count.items():
-        if not tally[k]:
-            tally[k].extend([0] * ((len(bwt) - 1) // tally_factor + 1))
-        tally[k].append(v)
-    return tally
-
-
-def create_sa_sample(sa, factor):
-    sample = {}
-    for i in range(len(sa)):
-        if sa[i] % factor == 0:
-            sample[i] = sa[i]
-    return sample
+            block_counts = count_symbols(bwt, repeat(code), range(0, len(bwt), tally_factor),
+                                         range(tally_factor, len(bwt) + tally_factor, tally_factor))
+            tally.extend(accumulate(block_counts))
+    return tally, rows
+
+
+def create_rank_directory(bwt, block_size, alphabet_size):
+    """ Creates RankDirectory with ranks of every block_size-th position.
+     Superblocks are as long as relative block counts held by block typecode allow. """
+    block_typecode = 'B' if block_size < byte_block_counts_limit else 'H'
+    # relative count of the last block of a superblock is at most superblock size minus one block
+    blocks_per_superblock = max(1, (2 ** (8 * array(block_typecode).itemsize) - 1 + block_size) // block_size)
+    block_rows = (len(bwt) + block_size - 1) // block_size + 1
+    superblock_rows = (block_rows + blocks_per_superblock - 1) // blocks_per_superblock
+    superblocks = array(index_typecode(len(bwt)))
+    blocks = array(block_typecode)
+    for code in range(alphabet_size):
+        block_counts = count_symbols(bwt, repeat(code), range(0, len(bwt), block_size),
+                                     range(block_size, len(bwt) + block_size, block_size))
+        ranks = list(accumulate(block_counts, initial=0))
+        superblock_ranks = ranks[::blocks_per_superblock]
+        superblocks.extend(superblock_ranks)
+        blocks.extend(map(sub, ranks, (rank for rank in superblock_ranks for _ in range(blocks_per_superblock))))
+    return RankDirectory(bwt, superblocks, blocks, block_size, blocks_per_superblock, superblock_rows, block_rows)
+
+
+def create_sa_sample(sa, factor, flags=None):
+    if flags is None:
+        flags = sampled_rows(sa, factor)
+    values = array(index_typecode(len(sa)), compress(sa, flags))
+    return SASample(bit_vector_from_bytes(pack_bits(flags), len(sa)), values, factor)
+
+
+def create_isa_sample(sa, factor, terminals=None, flags=None):
+    """ Creates ISASample of suffix array sa with rows of every factor-th position and of given terminal
+     positions, which default to the last position """
+    typecode = index_typecode(len(sa))
+    terminals = array(typecode, [len(sa) - 1] if terminals is None else terminals)
+    if flags is None:
+        flags = sampled_rows(sa, factor)
+    rows = list(compress(range(len(sa)), flags))
+    positions = list(compress(sa, flags))
+    # sampled positions are consecutive multiples of factor, so sorting rows by them puts each in its place
+    values = array(typecode, map(rows.__getitem__, sorted(range(len(rows)), key=positions.__getitem__)))
+    terminal_values = array(typecode, map(sa.index, terminals))
+    return ISASample(values, terminals, terminal_values, factor)
 
 
 def create_f_column(text):
@@ -154,18 +665,92 @@ def create_f_column(text):
     return FColumn(count, first_occurrence)
 
 
-def create_tally(bwt, tally_factor):
-    return Tally(create_ranks_tally(bwt, tally_factor), tally_factor)
-
-
-def create_fm_index(text, sa_factor, tally_factor):
-    t = terminate_string(text)
-    sa = suffix_array_manber_myers(t)
-    sa_sample = create_sa_sample(sa, sa_factor)
-    bwt = bw_transform(t, sa)
-    tally = create_tally(bwt, tally_factor)
+def create_index_components(t, sa, sa_factor, isa_factor=0):
+    """ Returns FColumn, encoded BWT, SASample and ISASample (None if isa_factor is 0) of terminated text t
+     with suffix array sa. Every component is derived from encoded text and sa with bulk operations,
+     and flags of sampled rows are computed once if both samples have the same factor. """
     f_column = create_f_column(t)
-    return FMIndex(bwt, sa_sample, tally, f_column)
+    bwt = create_encoded_bwt(t, sa, f_column)
+    flags = sampled_rows(sa, sa_factor)
+    sa_sample = create_sa_sample(sa, sa_factor, flags)
+    isa_sample = None
+    if isa_factor:
+        isa_sample = create_isa_sample(sa, isa_factor, flags=flags if isa_factor == sa_factor else None)
+    return f_column, bwt, sa_sample, isa_sample
+
+
+def create_kmer_table(tally, f_column, length):
+    """ Creates KmerTable of intervals of all strings of at most length characters.
+     Intervals of strings one character longer are found by one backward step from the shorter ones,
+     for all of them at once with bulk tally lookups. Table holds sum of (alphabet size - 1) ** i
+     for i from 1 to length start and end pairs. """
+    if length < 1:
+        raise ValueError("kmer length must be at least 1, got %d" % length)
+    base = len(f_column.alphabet) - 1
+    typecode = index_typecode(len(tally))
+    offsets = [0, 0]
+    starts = array(typecode, [f_column.code_first_occurrence(code) for code in range(1, base + 1)])
+    ends = array(typecode, [f_column.code_range(code)[1] for code in range(1, base + 1)])
+    level_starts, level_ends = list(starts), list(ends)
+    for _ in range(2, length + 1):
+        offsets.append(len(starts))
+        indices = level_starts + level_ends
+        new_starts, new_ends = [], []
+        for code in range(1, base + 1):
+            tallies = tally.rank_many(indices, [code] * len(indices))
+            first_occurrence = f_column.code_first_occurrence(code)
+            new_starts.extend(map(add, repeat(first_occurrence), tallies[:len(level_starts)]))
+            new_ends.extend(map(add, repeat(first_occurrence), tallies[len(level_starts):]))
+        level_starts, level_ends = new_starts, new_ends
+        starts.extend(level_starts)
+        ends.extend(level_ends)
+    return KmerTable(length, base, offsets, starts, ends)
+
+
+def has_sampled_tally(fm_index):
+    """ Returns whether fm_index keeps plain BWT next to tally rows sampled every factor symbols.
+     Attributes are checked instead of class, so indexes built by this module run as a script qualify too. """
+    tally = fm_index._tally
+    return getattr(tally, "bwt", None) is fm_index._bwt and hasattr(tally, "ranks")
+
+
+def create_tally(bwt, tally_factor, alphabet_size):
+    ranks, rows = create_ranks_tally(bwt, tally_factor, alphabet_size)
+    return Tally(bwt, ranks, tally_factor, rows)
+
+
+def create_wavelet_tally(bwt, tally_factor, alphabet_size):
+    """ Wavelet matrix answers rank queries without sampling, so tally_factor is not used """
+    return create_wavelet_matrix(bwt, alphabet_size)
+
+
+def create_dna_tally(bwt, tally_factor, alphabet_size):
+    """ Packed BWT is sampled every tally_factor symbols rounded up to a multiple of four """
+    return create_packed_dna(bwt, alphabet_size, tally_factor)
+
+
+# structures answering symbol and rank queries over encoded BWT, selectable by name
+rank_backends = {
+    "tally": create_tally,
+    "directory": create_rank_directory,
+    "wavelet": create_wavelet_tally,
+    "dna": create_dna_tally,
+}
+
+
+def create_fm_index(text, sa_factor, tally_factor, sa_builder=suffix_array_sais, backend="tally", kmer_length=0,
+                    isa_factor=0):
+    """ Creates FMIndex of text. If isa_factor is given, every isa_factor-th text position is sampled
+     for extraction, so text itself need not be kept. """
+    t = terminate_string(text)
+    sa = sa_builder(t)
+    f_column, bwt, sa_sample, isa_sample = create_index_components(t, sa, sa_factor, isa_factor)
+    tally = rank_backends[backend](bwt, tally_factor, len(f_column.alphabet))
+    if not isinstance(tally, Tally):
+        # backend answers symbol queries by itself, so plain BWT is not kept
+        bwt = tally
+    kmer_table = create_kmer_table(tally, f_column, kmer_length) if kmer_length else None
+    return FMIndex(bwt, sa_sample, tally, f_column, kmer_table, isa_sample)
 
 
 if __name__ == "__main__":
@@ -179,13 +764,32 @@ if __name__ == "__main__":
                         help="Suffix array factor. Defines compression level of suffix array. If omitted, full size suffix array will be used.")
     parser.add_argument("--tally_factor", type=positive_int, default=1, required=False,
                         help="Ranks tally matrix factor. Defines compression level of tally matrix. If omitted, full size tally will be used.")
+    parser.add_argument("--sa_algorithm", choices=sorted(sa_builders), default="sais", required=False,
+                        help="Suffix array construction algorithm. If omitted, linear time SA-IS will be used.")
+    parser.add_argument("--backend", choices=sorted(rank_backends), default="tally", required=False,
+                        help="Structure answering rank queries over BWT. If omitted, sampled tally matrix will be used. dna packs four most frequent symbols two bits each.")
+    parser.add_argument("--kmer_length", type=non_negative_int, default=0, required=False,
+                        help="Length of the longest strings whose intervals are precomputed, so search of every pattern starts from interval of its last kmer_length characters. Table size grows as alphabet size ** kmer_length. If omitted, no table is built.")
+    parser.add_argument("--fasta", action="store_true",
+                        help="Text file is in FASTA or FASTQ format. Records are indexed separately and hits are reported as record:offset.")
+    parser.add_argument("--workers", type=positive_int, default=1, required=False,
+                        help="Number of worker processes searching patterns in parallel. If omitted, patterns are searched in a single process.")
+    parser.add_argument("--stats", action="store_true",
+                        help="Count backward steps, tally lookups, scanned BWT characters, LF walks and interval widths of all queries and print their totals to standard error.")
     args = vars(parser.parse_args())
+    if args["workers"] > 1 and args["backend"] != "tally":
+        parser.error("--workers can only be used with tally backend")
+    if args["workers"] > 1 and args["stats"]:
+        parser.error("--stats can not be used with --workers")
 
     text_path = args["text"]
     patterns_path = args["patterns"]
     results_path = args["results"]
     sa_factor = args["sa_factor"]
     tally_factor = args["tally_factor"]
+    sa_builder = sa_builders[args["sa_algorithm"]]
+    workers = args["workers"]
+    backend = args["backend"]
 
     # read input files
     if not os.path.isfile(text_path):
@@ -193,14 +797,37 @@ if __name__ == "__main__":
     elif not os.path.isfile(patterns_path):
         print("File could not be found on path " + patterns_path)
     else:
-        with open(text_path, 'r') as f:
-            text = ''.join(f.read().splitlines())
+        if args["fasta"]:
+            with open(text_path, 'rb') as f:
+                text, records = read_sequences(f)
+        else:
+            with open(text_path, 'r') as f:
+                text = ''.join(f.read().splitlines())
         with open(patterns_path, 'r') as f:
             patterns = f.read().splitlines()
 
     # search for patterns
-    fm_index = create_fm_index(text, sa_factor, tally_factor)
-    results = [fm_index.query(pattern) for pattern in patterns]
+    fm_index = create_fm_index(text, sa_factor, tally_factor, sa_builder, backend, args["kmer_length"])
+    if args["stats"]:
+        from instrumentation import instrument
+        fm_index = instrument(fm_index)
+    if workers > 1:
+        # workers memory map the same index file instead of receiving a pickled copy of the index
+        import tempfile
+        from index_file import save_index, query_in_parallel
+        with tempfile.TemporaryDirectory() as index_directory:
+            index_path = os.path.join(index_directory, "index.fmi")
+            save_index(fm_index, index_path)
+            results = query_in_parallel(index_path, patterns, workers)
+    else:
+        results = [fm_index.query(pattern) for pattern in patterns]
+    if args["fasta"]:
+        results = [[records.names[record_id] + ":" + str(offset) for record_id, offset in map(records.locate, result)]
+                   for result in results]
+
+    if args["stats"]:
+        import json
+        print(json.dumps(fm_index.stats()), file=sys.stderr)
 
     # write results
     if results_path:
@@ -0,0 +1,122 @@
+from bisect import bisect_left, bisect_right
+
+from fmindex_optimized import *
+
+
+def count_smaller_suffixes(fm_index, document):
+    """ Returns list whose p-th item is number of suffixes of indexed text smaller than suffix of
+     document + terminal_char starting on position p. Terminal of document is larger than terminals
+     already indexed, so its own suffix follows all of their rows, and longer suffixes are placed by
+     one backward step each, starting from the shortest one. """
+    f_column = fm_index._f_column
+    smaller = [0] * (len(document) + 1)
+    k = f_column._counts[terminal_char]
+    smaller[len(document)] = k
+    for p in range(len(document) - 1, -1, -1):
+        c = document[p]
+        code = f_column._codes.get(c)
+        if code is None:
+            # character is not in indexed text, so only suffixes starting with smaller characters precede it
+            i = bisect_left(f_column.alphabet, c)
+            k = f_column.code_first_occurrences[i] if i < len(f_column.alphabet) else len(fm_index._bwt)
+        else:
+            k = f_column.code_first_occurrence(code) + fm_index._find_tally(k, code)
+        smaller[p] = k
+    return smaller
+
+
+def recode_bwt(bwt, old_alphabet, f_column):
+    """ Returns BWT encoded with codes of old_alphabet re-encoded with codes of f_column alphabet """
+    new_codes = [f_column._codes[c] for c in old_alphabet]
+    if len(f_column.alphabet) <= 256:
+        if new_codes == list(range(len(new_codes))) and isinstance(bwt, bytes):
+            return bwt
+        return bytes(bwt).translate(bytes(new_codes + [0] * (256 - len(new_codes))))
+    return array(index_typecode(len(f_column.alphabet)), map(new_codes.__getitem__, bwt))
+
+
+def append_isa_sample(isa_sample, length, sa, smaller):
+    """ Returns ISASample of indexed text of given length followed by document whose suffix array is sa.
+     Earlier rows move down by number of document suffixes merged in front of them, and document
+     suffix of rank i is placed after smaller[p] + i rows. """
+    sorted_smaller = sorted(smaller)
+    document_rows = [0] * len(sa)
+    for i, p in enumerate(sa):
+        document_rows[p] = smaller[p] + i
+    typecode = index_typecode(length + len(sa))
+    factor = isa_sample.factor
+
+    def shift(rows):
+        return map(add, rows, map(bisect_right, repeat(sorted_smaller), rows))
+
+    values = array(typecode, shift(isa_sample.values))
+    values.extend(document_rows[-length % factor::factor])
+    terminals = array(typecode, isa_sample.terminals)
+    terminals.append(length + len(sa) - 1)
+    terminal_values = array(typecode, shift(isa_sample.terminal_values))
+    terminal_values.append(document_rows[-1])
+    return ISASample(values, terminals, terminal_values, factor)
+
+
+def append_document(fm_index, document, sa_builder=suffix_array_sais):
+    """ Returns FMIndex of indexed text followed by document and its own terminal_char, without rebuilding it.
+     Suffix array is built only for the document, and its suffixes are merged into existing rows by
+     positions found with backward search in the existing index. Positions of document start at
+     length of previously indexed text, which includes terminal of every earlier document.
+     Python level work grows with document length times tally_factor, while BWT, SA sample and tally
+     of the whole text are only copied and recounted with bytes operations.
+     Terminals sort in order of documents, and start of every document is sampled, so no LF walk
+     crosses a document boundary. Inverse suffix array sample, if index has one, is extended the same way. """
+    if not isinstance(fm_index._tally, Tally):
+        raise ValueError("Only FM index with tally backend can be appended to")
+    if not document or terminal_char in document:
+        raise ValueError("Document must be non-empty and must not contain terminal character")
+    length = len(fm_index._bwt)
+    old_f_column = fm_index._f_column
+    sa_sample = fm_index._sa_sample
+    t = document + terminal_char
+    sa = sa_builder(t)
+    smaller = count_smaller_suffixes(fm_index, document)
+
+    f_column = FColumn(old_f_column._counts + Counter(t),
+                       calculate_first_occurrences(old_f_column._counts + Counter(t)))
+    old_bwt = recode_bwt(fm_index._bwt, old_f_column.alphabet, f_column)
+    codes = f_column._codes
+    bwt = bytearray() if isinstance(old_bwt, bytes) else array(old_bwt.typecode)
+    # marks of rows as '0' and '1' characters in row order, so they can be merged with string slices
+    old_flags = bin(int.from_bytes(sa_sample.marks.bits, 'little') | 1 << length)[3:][::-1]
+    flags = []
+    values = array(index_typecode(length + len(t)))
+    old_values = sa_sample.values
+    previous_row, previous_rank = 0, 0
+    # suffixes of document come in increasing order, so numbers of smaller suffixes do not decrease
+    for p in sa:
+        k = smaller[p]
+        if k > previous_row:
+            rank = sa_sample.marks.rank(k)
+            bwt.extend(old_bwt[previous_row:k])
+            flags.append(old_flags[previous_row:k])
+            values.extend(old_values[previous_rank:rank])
+            previous_row, previous_rank = k, rank
+        bwt.append(codes[t[p - 1]] if p else 0)
+        if p == 0 or (length + p) % sa_sample.factor == 0:
+            flags.append('1')
+            values.append(length + p)
+        else:
+            flags.append('0')
+    bwt.extend(old_bwt[previous_row:])
+    flags.append(old_flags[previous_row:])
+    values.extend(old_values[previous_rank:])
+    if isinstance(bwt, bytearray):
+        bwt = bytes(bwt)
+
+    flags = ''.join(flags)
+    marks = bit_vector_from_bytes(int(flags[::-1], 2).to_bytes((len(flags) + 7) // 8, 'little'), len(flags))
+    tally = create_tally(bwt, fm_index._tally.factor, len(f_column.alphabet))
+    kmer_table = None
+    if fm_index._kmer_table is not None:
+        kmer_table = create_kmer_table(tally, f_column, fm_index._kmer_table.length)
+    isa_sample = None
+    if fm_index._isa_sample is not None:
+        isa_sample = append_isa_sample(fm_index._isa_sample, length, sa, smaller)
+    return FMIndex(bwt, SASample(marks, values, sa_sample.factor), tally, f_column, kmer_table, isa_sample)
@@ -0,0 +1,223 @@
+import json
+import mmap
+import sys
+
+from fmindex_optimized import *
+from util import parallel_map_chunks
+
+# Index file layout:
+#   magic, 4 byte little endian version, 4 byte little endian header length, JSON header,
+#   followed by raw array sections aligned to section_alignment bytes.
+# Section offsets, lengths and typecodes are stored in the header.
+index_file_magic = b'FMINDEX\0'
+index_file_version = 1
+section_alignment = 8
+
+
+def padding(offset):
+    return -offset % section_alignment
+
+
+def index_sections(fm_index):
+    """ Returns arrays that make up fm_index, keyed by section name """
+    bwt = fm_index._bwt
+    sa_sample = fm_index._sa_sample
+    sections = {
+        "bwt": bwt if not isinstance(bwt, bytes) else array('B', bwt),
+        "tally": fm_index._tally.ranks,
+        "sa_marks": array('B', sa_sample.marks.bits),
+        "sa_block_ranks": sa_sample.marks.block_ranks,
+        "sa_values": sa_sample.values,
+    }
+    kmer_table = fm_index._kmer_table
+    if kmer_table is not None:
+        sections.update(kmer_starts=kmer_table.starts, kmer_ends=kmer_table.ends)
+    isa_sample = fm_index._isa_sample
+    if isa_sample is not None:
+        sections.update(isa_values=isa_sample.values, isa_terminals=isa_sample.terminals,
+                        isa_terminal_values=isa_sample.terminal_values)
+    return sections
+
+
+def write_index_file(path, header, sections):
+    """ Writes index file with given header fields. Sections map section name to (typecode, length, chunks),
+     where chunks is an iterable over raw bytes of the section, so sections can be streamed from other files. """
+    header = dict(header, byteorder=sys.byteorder, sections={})
+    offset = 0
+    for name, (typecode, length, _) in sections.items():
+        itemsize = array(typecode).itemsize
+        header["sections"][name] = [offset, length, typecode, itemsize]
+        size = length * itemsize
+        offset += size + padding(size)
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * padding(len(index_file_magic) + 8 + len(header_bytes))
+    with open(path, 'wb') as f:
+        f.write(index_file_magic)
+        f.write(index_file_version.to_bytes(4, 'little'))
+        f.write(len(header_bytes).to_bytes(4, 'little'))
+        f.write(header_bytes)
+        for _, _, chunks in sections.values():
+            size = 0
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+            f.write(bytes(padding(size)))
+
+
+def save_index(fm_index, path):
+    """ Writes fm_index into binary index file on given path """
+    if not has_sampled_tally(fm_index):
+        raise ValueError("Only FM index with tally backend can be written to index file")
+    f_column = fm_index._f_column
+    header = {
+        "length": len(fm_index._bwt),
+        "alphabet": f_column.alphabet,
+        "counts": [f_column._counts[c] for c in f_column.alphabet],
+        "tally_factor": fm_index._tally.factor,
+        "tally_rows": fm_index._tally.rows,
+        "sa_factor": fm_index._sa_sample.factor,
+    }
+    if fm_index._kmer_table is not None:
+        header["kmer_length"] = fm_index._kmer_table.length
+        header["kmer_offsets"] = fm_index._kmer_table.offsets
+    if fm_index._isa_sample is not None:
+        header["isa_factor"] = fm_index._isa_sample.factor
+    sections = {name: (section.typecode, len(section), [section.tobytes()])
+                for name, section in index_sections(fm_index).items()}
+    write_index_file(path, header, sections)
+
+
+def read_header(buffer):
+    """ Returns header of index file mapped into buffer and offset of its first section """
+    if buffer[:len(index_file_magic)] != index_file_magic:
+        raise ValueError("Not an FM index file")
+    position = len(index_file_magic)
+    version = int.from_bytes(buffer[position:position + 4], 'little')
+    if version != index_file_version:
+        raise ValueError("Unsupported FM index file version " + str(version))
+    header_length = int.from_bytes(buffer[position + 4:position + 8], 'little')
+    position += 8
+    header = json.loads(bytes(buffer[position:position + header_length]).decode('utf-8'))
+    if header["byteorder"] != sys.byteorder:
+        raise ValueError("FM index file was written on a machine with different byte order")
+    return header, position + header_length
+
+
+def load_index(path):
+    """ Maps index file on given path into memory and returns FMIndex reading directly from mapped pages.
+     Pages are shared between all processes that load the same file. """
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header, data_offset = read_header(buffer)
+    view = memoryview(buffer)
+    sections = {}
+    for name, (offset, length, typecode, itemsize) in header["sections"].items():
+        start = data_offset + offset
+        if array(typecode).itemsize != itemsize:
+            raise ValueError("FM index file was written with different integer sizes")
+        sections[name] = view[start:start + length * itemsize].cast(typecode)
+
+    alphabet = header["alphabet"]
+    counts = Counter(dict(zip(alphabet, header["counts"])))
+    f_column = FColumn(counts, calculate_first_occurrences(counts))
+    tally = Tally(sections["bwt"], sections["tally"], header["tally_factor"], header["tally_rows"])
+    marks = BitVector(sections["sa_marks"], sections["sa_block_ranks"], header["length"])
+    sa_sample = SASample(marks, sections["sa_values"], header["sa_factor"])
+    kmer_table = None
+    if "kmer_length" in header:
+        kmer_table = KmerTable(header["kmer_length"], len(alphabet) - 1, header["kmer_offsets"],
+                               sections["kmer_starts"], sections["kmer_ends"])
+    isa_sample = None
+    if "isa_factor" in header:
+        isa_sample = ISASample(sections["isa_values"], sections["isa_terminals"], sections["isa_terminal_values"],
+                               header["isa_factor"])
+    return FMIndex(sections["bwt"], sa_sample, tally, f_column, kmer_table, isa_sample)
+
+
+# FM index loaded by every worker process of query_in_parallel
+worker_fm_index = None
+
+
+def load_worker_index(path):
+    global worker_fm_index
+    worker_fm_index = load_index(path)
+
+
+def query_chunk(patterns):
+    return [worker_fm_index.query(pattern) for pattern in patterns]
+
+
+def query_in_parallel(path, patterns, workers):
+    """ Searches patterns on a pool of worker processes that all memory map index file on given path """
+    return parallel_map_chunks(query_chunk, patterns, workers, initializer=load_worker_index, initargs=(path,))
+
+
+if __name__ == "__main__":
+    # create command line arguments parser
+    parser = argparse.ArgumentParser(description='Build BWT + FM index file once and search it many times.')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Build index file from text file.")
+    build_parser.add_argument("-t", "--text", required=True, help="Path to text file.")
+    build_parser.add_argument("-i", "--index", required=True, help="Path to output index file.")
+    build_parser.add_argument("--sa_factor", type=positive_int, default=1, required=False,
+                              help="Suffix array factor. Defines compression level of suffix array. If omitted, full size suffix array will be used.")
+    build_parser.add_argument("--tally_factor", type=positive_int, default=1, required=False,
+                              help="Ranks tally matrix factor. Defines compression level of tally matrix. If omitted, full size tally will be used.")
+    build_parser.add_argument("--sa_algorithm", choices=sorted(sa_builders), default="sais", required=False,
+                              help="Suffix array construction algorithm. If omitted, linear time SA-IS will be used.")
+    build_parser.add_argument("--kmer_length", type=positive_int, required=False,
+                              help="Precompute suffix array intervals of all strings up to this length and store them in index file.")
+    build_parser.add_argument("--isa_factor", type=positive_int, required=False,
+                              help="Inverse suffix array factor. If given, every isa_factor-th text position is sampled, so text can be extracted from index file.")
+    build_parser.add_argument("--memory_budget", type=positive_int, required=False,
+                              help="Approximate number of bytes of memory used for construction. If given, suffixes are sorted in chunks on disk and the index is streamed into the file.")
+    query_parser = subparsers.add_parser("query", help="Search patterns in previously built index file.")
+    query_parser.add_argument("-i", "--index", required=True, help="Path to index file.")
+    query_parser.add_argument("-p", "--patterns", required=True, help="Path to patterns file.")
+    query_parser.add_argument("-r", "--results", required=False,
+                              help="Path to output results file. If omitted, results will be printed to standard output.")
+    query_parser.add_argument("--workers", type=positive_int, default=1, required=False,
+                              help="Number of worker processes searching patterns in parallel. If omitted, patterns are searched in a single process.")
+    args = vars(parser.parse_args())
+
+    if args["command"] == "build":
+        if not os.path.isfile(args["text"]):
+            print("File could not be found on path " + args["text"])
+            sys.exit(1)
+        if args["memory_budget"] and (args["isa_factor"] or args["kmer_length"]):
+            parser.error("--isa_factor and --kmer_length can not be used with --memory_budget")
+        if args["memory_budget"]:
+            from external import build_index_file
+            try:
+                build_index_file(args["text"], args["index"], args["sa_factor"], args["tally_factor"],
+                                 args["memory_budget"])
+            except ValueError as e:
+                print(e)
+                sys.exit(1)
+        else:
+            with open(args["text"], 'r') as f:
+                text = ''.join(f.read().splitlines())
+            fm_index = create_fm_index(text, args["sa_factor"], args["tally_factor"], sa_builders[args["sa_algorithm"]],
+                                       kmer_length=args["kmer_length"] or 0, isa_factor=args["isa_factor"] or 0)
+            save_index(fm_index, args["index"])
+    else:
+        for path in (args["index"], args["patterns"]):
+            if not os.path.isfile(path):
+                print("File could not be found on path " + path)
+                sys.exit(1)
+        with open(args["patterns"], 'r') as f:
+            patterns = f.read().splitlines()
+
+        # search for patterns
+        if args["workers"] > 1:
+            results = query_in_parallel(args["index"], patterns, args["workers"])
+        else:
+            fm_index = load_index(args["index"])
+            results = [fm_index.query(pattern) for pattern in patterns]
+
+        # write results
+        if args["results"]:
+            with open(args["results"], 'w') as f:
+                f.writelines("\n".join([" ".join(str(e) for e in result) for result in results]))
+        else:
+            print("\n".join([" ".join(str(e) for e in result) for result in results]))
@@ -0,0 +1,113 @@
+from collections import deque
+
+from fmindex_optimized import *
+
+# Default number of per query records kept by InstrumentedFMIndex
+query_history_size = 1000
+
+
+class InstrumentedFMIndex(FMIndex):
+    """ FMIndex sharing components of another one, that counts work done by every query.
+     Counters are kept for every query in history, newest last, and summed over all queries in totals:
+       backward_steps - backward search steps taken
+       rank_lookups, checkpoint_hits - rank lookups and those of them answered from a tally row alone
+       scanned_characters - BWT characters counted between tally rows and looked up rank
+       interval_width - number of rows of pattern suffix array interval
+       located_rows, lf_steps, max_lf_walk - rows resolved to positions and LF steps taken to reach sampled rows
+       lf_walks - numbers of located rows keyed by length of their LF walk
+     Plain FMIndex is not changed, so instrumentation costs nothing unless this class is used. """
+    def __init__(self, fm_index, history_size=query_history_size):
+        super().__init__(fm_index._bwt, fm_index._sa_sample, fm_index._tally, fm_index._f_column, fm_index._kmer_table,
+                         fm_index._isa_sample)
+        self.history = deque(maxlen=history_size)
+        self.totals = Counter()
+        self.total_lf_walks = Counter()
+        # counters of work done outside of any query are not kept in history
+        self._current = Counter(lf_walks=Counter())
+        self._walk_batches = None
+
+    def stats(self):
+        """ Returns totals over all queries, with histogram of LF walk lengths """
+        return dict(self.totals, lf_walks=dict(sorted(self.total_lf_walks.items())))
+
+    def _count(self, name, value=1):
+        self._current[name] += value
+        self.totals[name] += value
+
+    def _start_record(self, **fields):
+        """ Starts history record that counters of following work are added to """
+        self._current = Counter(fields)
+        self._current["lf_walks"] = Counter()
+        self.history.append(self._current)
+
+    def _count_ranks(self, indices):
+        self._count("rank_lookups", len(indices))
+        if not has_sampled_tally(self):
+            return
+        factor = self._tally.factor
+        offsets = [index % factor for index in indices]
+        self._count("checkpoint_hits", offsets.count(0))
+        self._count("scanned_characters", sum(offsets))
+
+    def _backward_search(self, pattern):
+        self._start_record(pattern=pattern)
+        self.totals["queries"] += 1
+        start_index, end_index = super()._backward_search(pattern)
+        self._count("interval_width", end_index - start_index)
+        return start_index, end_index
+
+    def query_many(self, patterns):
+        # one record is kept for all patterns searched together
+        self._start_record(patterns=len(patterns))
+        self.totals["queries"] += len(patterns)
+        intervals = super().query_many(patterns)
+        # every pattern made of indexed characters is stepped through its whole length
+        self._count("backward_steps", sum(len(pattern) - 1 for pattern in patterns if self._f_column.encode(pattern)))
+        self._count("interval_width", sum(end_index - start_index for start_index, end_index in intervals))
+        return intervals
+
+    def _find_preceders(self, start_index, end_index, code):
+        self._count("backward_steps")
+        return super()._find_preceders(start_index, end_index, code)
+
+    def _find_tally(self, index, code):
+        if has_sampled_tally(self):
+            # single lookups count from the closer of two neighbouring tally rows
+            offset = index % self._tally.factor
+            self._count("rank_lookups")
+            self._count("checkpoint_hits", offset == 0)
+            self._count("scanned_characters", min(offset, self._tally.factor - offset,
+                                                  max(0, len(self._bwt) - index)) if offset else 0)
+        else:
+            self._count("rank_lookups")
+        return super()._find_tally(index, code)
+
+    def _find_tallies(self, indices, codes):
+        self._count_ranks(indices)
+        if self._walk_batches is not None:
+            self._walk_batches.append(len(indices))
+        return super()._find_tallies(indices, codes)
+
+    def _find_suffixes(self, rows):
+        # every LF round looks up ranks of rows still unresolved, so sizes of rounds give walk lengths
+        self._walk_batches = []
+        try:
+            suffixes = super()._find_suffixes(rows)
+        finally:
+            batches = [len(rows)] + self._walk_batches + [0]
+            self._walk_batches = None
+        self._count("located_rows", len(rows))
+        self._count("lf_steps", sum(batches[1:]))
+        for steps in range(len(batches) - 1):
+            resolved = batches[steps] - batches[steps + 1]
+            if resolved:
+                self._current["lf_walks"][steps] += resolved
+                self.total_lf_walks[steps] += resolved
+        self._current["max_lf_walk"] = max(self._current["max_lf_walk"], len(batches) - 2)
+        self.totals["max_lf_walk"] = max(self.totals["max_lf_walk"], len(batches) - 2)
+        return suffixes
+
+
+def instrument(fm_index, history_size=query_history_size):
+    """ Returns InstrumentedFMIndex over components of fm_index """
+    return InstrumentedFMIndex(fm_index, history_size)
@@ -0,0 +1,127 @@
+from bisect import bisect_left, bisect_right
+from heapq import nsmallest
+
+from fmindex_optimized import *
+
+
+class RLFMIndex:
+    """ Run-length compressed FM index. Every structure has one entry per BWT run, so its size grows with
+     number of runs r instead of text length.
+     BWT is kept as start row and symbol of every run, with per symbol prefix sums of run lengths for rank.
+     Positions are found as in r-index: backward search keeps suffix array value of the last row of interval
+     (toehold), and remaining values are enumerated with phi(SA[i]) = SA[i - 1], sampled at run boundaries. """
+    def __init__(self, length, run_starts, run_heads, symbol_runs, symbol_run_lengths, run_end_suffixes,
+                 last_suffix, phi_keys, phi_values, f_column):
+        self._length = length
+        self._run_starts = run_starts
+        self._run_heads = run_heads
+        self._symbol_runs = symbol_runs
+        self._symbol_run_lengths = symbol_run_lengths
+        self._run_end_suffixes = run_end_suffixes
+        self._last_suffix = last_suffix
+        self._phi_keys = phi_keys
+        self._phi_values = phi_values
+        self._f_column = f_column
+
+    def query(self, pattern):
+        return list(self.locate(pattern))
+
+    def memory_report(self):
+        """ Returns bytes of data taken by every component of index and their total """
+        report = {
+            "runs": buffer_size(self._run_starts) + buffer_size(self._run_heads),
+            "symbol_runs": sum(map(buffer_size, self._symbol_runs)) + sum(map(buffer_size, self._symbol_run_lengths)),
+            "run_end_suffixes": buffer_size(self._run_end_suffixes),
+            "phi": buffer_size(self._phi_keys) + buffer_size(self._phi_values),
+            "f_column": self._f_column.memory_usage(),
+        }
+        report["total"] = sum(report.values())
+        return report
+
+    def count(self, pattern):
+        """ Returns number of occurrences of pattern without locating any of them """
+        start_index, end_index, _ = self._backward_search(pattern)
+        return end_index - start_index
+
+    def locate(self, pattern, limit=None):
+        """ Yields positions of pattern occurrences, starting from the last row of suffix array interval """
+        start_index, end_index, suffix = self._backward_search(pattern)
+        count = end_index - start_index if limit is None else min(end_index - start_index, limit)
+        for i in range(count):
+            yield suffix
+            if i + 1 < count:
+                suffix = self._phi(suffix)
+
+    def locate_sorted(self, pattern, limit=None):
+        if limit is None:
+            return sorted(self.locate(pattern))
+        return nsmallest(limit, self.locate(pattern))
+
+    def _backward_search(self, pattern):
+        """ Returns suffix array interval (start, end) of rows prefixed by pattern and suffix array value of row end - 1 """
+        reverse_codes = self._f_column.encode(pattern[::-1])
+        if not reverse_codes:
+            return 0, 0, None
+        start_index, end_index, suffix = 0, self._length, self._last_suffix
+        for code in reverse_codes:
+            first_occurrence = self._f_column.code_first_occurrence(code)
+            new_start_index = first_occurrence + self._find_tally(start_index, code)
+            new_end_index = first_occurrence + self._find_tally(end_index, code)
+            if new_start_index == new_end_index:
+                return 0, 0, None
+            run = bisect_right(self._run_starts, end_index - 1) - 1
+            if self._run_heads[run] == code:
+                suffix -= 1
+            else:
+                # last occurrence of code before row end - 1 is the last row of a preceding run
+                runs = self._symbol_runs[code]
+                suffix = self._run_end_suffixes[runs[bisect_left(runs, run) - 1]] - 1
+            # suffix preceding the whole text starts with terminal_char at its end
+            suffix %= self._length
+            start_index, end_index = new_start_index, new_end_index
+        return start_index, end_index, suffix
+
+    def _find_tally(self, index, code):
+        """ Returns number of occurrences of symbol code in bwt[:index] """
+        if index == 0:
+            return 0
+        run = bisect_right(self._run_starts, index - 1) - 1
+        preceding_runs = bisect_left(self._symbol_runs[code], run)
+        tally = self._symbol_run_lengths[code][preceding_runs]
+        if self._run_heads[run] == code:
+            tally += index - self._run_starts[run]
+        return tally
+
+    def _phi(self, suffix):
+        """ Returns suffix array value preceding given one. phi(p) = phi(q) - (q - p) for the closest sampled q >= p """
+        i = bisect_left(self._phi_keys, suffix)
+        return self._phi_values[i] - (self._phi_keys[i] - suffix)
+
+
+def create_rlfm_index(text, sa_builder=suffix_array_sais):
+    t = terminate_string(text)
+    sa = sa_builder(t)
+    f_column = create_f_column(t)
+    bwt = create_encoded_bwt(t, sa, f_column)
+    length = len(bwt)
+    typecode = index_typecode(length)
+
+    run_starts = array(typecode, [i for i in range(length) if i == 0 or bwt[i] != bwt[i - 1]])
+    run_ends = list(run_starts[1:]) + [length]
+    run_heads = bytes(bwt[i] for i in run_starts) if isinstance(bwt, bytes) \
+        else array(bwt.typecode, [bwt[i] for i in run_starts])
+    symbol_runs = [array(typecode) for _ in f_column.alphabet]
+    symbol_run_lengths = [array(typecode, [0]) for _ in f_column.alphabet]
+    for run, (start, end) in enumerate(zip(run_starts, run_ends)):
+        code = bwt[start]
+        symbol_runs[code].append(run)
+        symbol_run_lengths[code].append(symbol_run_lengths[code][-1] + end - start)
+    run_end_suffixes = array(typecode, [sa[end - 1] for end in run_ends])
+
+    # phi is sampled at positions preceding suffixes that start a run
+    inverse_sa = inverse_array(sa)
+    phi_samples = sorted((sa[start] - 1, sa[inverse_sa[sa[start] - 1] - 1]) for start in run_starts if sa[start] > 0)
+    phi_keys = array(typecode, [key for key, _ in phi_samples])
+    phi_values = array(typecode, [value for _, value in phi_samples])
+    return RLFMIndex(length, run_starts, run_heads, symbol_runs, symbol_run_lengths, run_end_suffixes,
+                     sa[length - 1], phi_keys, phi_values, f_column)
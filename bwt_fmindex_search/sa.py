@@ -137,8 +137,120 @@ def suffix_array_best(s):
     return inverse_array(line)
 
 
+def classify_suffixes(s):
+    """ Returns list of suffix types of integer coded string s. True marks S-type suffix, False marks L-type suffix """
+    n = len(s)
+    types = [False] * n
+    types[n - 1] = True
+    for i in range(n - 2, -1, -1):
+        types[i] = s[i] < s[i + 1] or (s[i] == s[i + 1] and types[i + 1])
+    return types
+
+
+def bucket_bounds(s, alphabet_size):
+    """ Returns start and end index of every character bucket in suffix array of s """
+    counts = [0] * alphabet_size
+    for c in s:
+        counts[c] += 1
+    starts = []
+    ends = []
+    total = 0
+    for count in counts:
+        starts.append(total)
+        total += count
+        ends.append(total)
+    return starts, ends
+
+
+def induce_sort(s, alphabet_size, types, lms):
+    """ Induces order of all suffixes of s from LMS suffixes given in their final relative order """
+    n = len(s)
+    sa = [-1] * n
+    starts, ends = bucket_bounds(s, alphabet_size)
+    tails = ends[:]
+    for i in reversed(lms):
+        tails[s[i]] -= 1
+        sa[tails[s[i]]] = i
+    heads = starts[:]
+    for i in range(n):
+        j = sa[i] - 1
+        if j >= 0 and not types[j]:
+            sa[heads[s[j]]] = j
+            heads[s[j]] += 1
+    tails = ends[:]
+    for i in range(n - 1, -1, -1):
+        j = sa[i] - 1
+        if j >= 0 and types[j]:
+            tails[s[j]] -= 1
+            sa[tails[s[j]]] = j
+    return sa
+
+
+def reduce_lms(s, lms, sa):
+    """ Names LMS substrings in order they appear in sa.
+     Returns reduced string and number of distinct names. """
+    is_lms = [False] * len(s)
+    for i in lms:
+        is_lms[i] = True
+    lms_end = {}
+    for k in range(len(lms) - 1):
+        lms_end[lms[k]] = lms[k + 1] + 1
+    lms_end[lms[-1]] = lms[-1] + 1
+    names = {}
+    name = -1
+    previous = None
+    for i in sa:
+        if i > 0 and is_lms[i]:
+            if previous is None or s[previous:lms_end[previous]] != s[i:lms_end[i]]:
+                name += 1
+            names[i] = name
+            previous = i
+    return [names[i] for i in lms], name + 1
+
+
+def suffix_array_sais_codes(s, alphabet_size):
+    """ Returns suffix array of integer coded string s which ends with unique smallest code 0.
+    SA-IS induced sorting, linear time. Reduced problems are solved with an explicit stack instead of recursion. """
+    levels = []
+    while True:
+        types = classify_suffixes(s)
+        lms = [i for i in range(1, len(s)) if types[i] and not types[i - 1]]
+        sa = induce_sort(s, alphabet_size, types, lms)
+        reduced, reduced_size = reduce_lms(s, lms, sa)
+        levels.append((s, alphabet_size, types, lms))
+        if reduced_size == len(reduced):
+            reduced_sa = inverse_array(reduced)
+            break
+        s, alphabet_size = reduced, reduced_size
+    while levels:
+        s, alphabet_size, types, lms = levels.pop()
+        reduced_sa = induce_sort(s, alphabet_size, types, [lms[i] for i in reduced_sa])
+    return reduced_sa
+
+
+def suffix_array_sais(text):
+    """ Returns suffix array of text in linear time, without recursion.
+    Characters are mapped to integer codes and a virtual sentinel is appended before sorting. """
+    if not text:
+        return []
+    code = {c: i + 1 for i, c in enumerate(sorted(set(text)))}
+    s = [code[c] for c in text]
+    s.append(0)
+    return suffix_array_sais_codes(s, len(code) + 1)[1:]
+
+
+# suffix array construction algorithms selectable by name
+sa_builders = {
+    "sais": suffix_array_sais,
+    "manber_myers": suffix_array_manber_myers,
+    "best": suffix_array_best,
+    "quicksort": suffix_array_quicksort,
+}
+
+
 if __name__ == "__main__":
     text = "bananananananananananananananananananananananananan$"
     print(suffix_array_quicksort(text))
     print(list(suffix_array_naive(text)))
-    print(suffix_array_manber_myers(text))
\ No newline at end of file
+    print(suffix_array_manber_myers(text))
+    print(suffix_array_sais(text))
\ No newline at end of file
@@ -0,0 +1,281 @@
+import asyncio
+import json
+import sys
+import time
+from collections import deque
+
+from fmindex_optimized import *
+
+# Protocol: every request and response is one JSON object on its own line.
+#   {"id": 1, "op": "count", "pattern": "abc"}              -> {"id": 1, "count": 3}
+#   {"id": 2, "op": "locate", "pattern": "abc", "limit": 2} -> {"id": 2, "positions": [7, 0]}
+#   {"id": 3, "op": "metrics"}                              -> {"id": 3, "metrics": {...}}
+# Failed requests are answered with {"id": ..., "error": reason}, reason being one of
+# "overloaded", "timeout" or a description of a malformed request.
+default_port = 8765
+max_batch_size = 256
+# seconds batcher waits for more requests after the first one of a batch
+max_batch_delay = 0.002
+request_queue_size = 4096
+request_timeout = 1.0
+# number of latest request latencies percentiles are computed from
+latency_window = 10000
+
+
+class ServerMetrics:
+    """ Request counts, batch sizes and latencies of a QueryServer """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.completed = 0
+        self.errors = Counter()
+        self.batches = 0
+        self.batched_requests = 0
+        self.latencies = deque(maxlen=latency_window)
+
+    def report(self, queue_depth):
+        latencies = sorted(self.latencies)
+        uptime = time.perf_counter() - self.started
+        report = {
+            "uptime_seconds": uptime,
+            "requests": self.requests,
+            "completed": self.completed,
+            "errors": dict(self.errors),
+            "queue_depth": queue_depth,
+            "batches": self.batches,
+            "mean_batch_size": self.batched_requests / self.batches if self.batches else 0,
+            "requests_per_second": self.completed / uptime if uptime else 0,
+        }
+        for p in [50, 95, 99]:
+            report["latency_p%d_ms" % p] = \
+                latencies[max(0, -(-p * len(latencies) // 100) - 1)] * 1000 if latencies else 0
+        return report
+
+
+class QueryServer:
+    """ Keeps FM index in memory and answers count and locate requests of TCP clients.
+     Requests of all connections go through one bounded queue and are searched in micro-batches:
+     backward search of a batch is done by query_many and its rows are located together, so they
+     share bulk rank lookups. Requests arriving while the queue is full are rejected as overloaded,
+     and requests not answered within timeout seconds are answered with a timeout error. """
+    def __init__(self, fm_index, batch_size=max_batch_size, batch_delay=max_batch_delay,
+                 queue_size=request_queue_size, timeout=request_timeout):
+        self.fm_index = fm_index
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.timeout = timeout
+        self.metrics = ServerMetrics()
+        self._queue = asyncio.Queue(queue_size)
+        self._server = None
+        self._batcher = None
+
+    async def start(self, host="127.0.0.1", port=default_port):
+        """ Starts listening and returns port the server is bound to, which is useful when port is 0 """
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        self._batcher = asyncio.ensure_future(self._run_batches())
+        return self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        await self._server.serve_forever()
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+
+    async def _handle_connection(self, reader, writer):
+        pending = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                # requests of one connection are answered as they finish, in any order
+                task = asyncio.ensure_future(self._answer(line, writer))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.wait(pending)
+        finally:
+            writer.close()
+
+    async def _answer(self, line, writer):
+        response = await self._handle_request(line)
+        writer.write(json.dumps(response).encode('utf-8') + b'\n')
+        await writer.drain()
+
+    async def _handle_request(self, line):
+        start_time = time.perf_counter()
+        self.metrics.requests += 1
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            op = request["op"]
+            if op == "metrics":
+                return {"id": request_id, "metrics": self.metrics.report(self._queue.qsize())}
+            if op not in ("count", "locate") or not isinstance(request["pattern"], str):
+                raise ValueError("unknown op " + str(op))
+            limit = request.get("limit")
+            if limit is not None and (not isinstance(limit, int) or limit < 0):
+                raise ValueError("limit must be a non-negative integer")
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.metrics.errors["bad_request"] += 1
+            return {"id": request_id, "error": "bad request: " + str(e)}
+
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((op, request["pattern"], limit, future))
+        except asyncio.QueueFull:
+            self.metrics.errors["overloaded"] += 1
+            return {"id": request_id, "error": "overloaded"}
+        try:
+            result = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.metrics.errors["timeout"] += 1
+            return {"id": request_id, "error": "timeout"}
+        self.metrics.completed += 1
+        self.metrics.latencies.append(time.perf_counter() - start_time)
+        return dict(result, id=request_id)
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_delay
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            # requests that timed out while queued are not searched
+            batch = [request for request in batch if not request[3].done()]
+            if not batch:
+                continue
+            self.metrics.batches += 1
+            self.metrics.batched_requests += len(batch)
+            results = await loop.run_in_executor(None, self._search_batch, batch)
+            for (_, _, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def _search_batch(self, batch):
+        """ Returns response fields of every request of batch """
+        intervals = self.fm_index.query_many([pattern for _, pattern, _, _ in batch])
+        rows = []
+        for (op, _, limit, _), (start_index, end_index) in zip(batch, intervals):
+            if op == "locate":
+                rows.extend(range(start_index, end_index if limit is None else min(end_index, start_index + limit)))
+        suffixes = iter(self.fm_index._find_suffixes(rows))
+        results = []
+        for (op, _, limit, _), (start_index, end_index) in zip(batch, intervals):
+            if op == "count":
+                results.append({"count": end_index - start_index})
+            else:
+                located = end_index - start_index if limit is None else min(end_index - start_index, limit)
+                results.append({"positions": [next(suffixes) for _ in range(located)]})
+        return results
+
+
+class QueryClient:
+    """ Client of QueryServer that may have many requests in flight on one connection """
+    def __init__(self):
+        self._reader = None
+        self._writer = None
+        self._next_id = 0
+        self._pending = {}
+        self._receiver = None
+
+    async def connect(self, host="127.0.0.1", port=default_port):
+        self._reader, self._writer = await asyncio.open_connection(host, port)
+        self._receiver = asyncio.ensure_future(self._receive())
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+        self._receiver.cancel()
+        try:
+            await self._receiver
+        except asyncio.CancelledError:
+            pass
+
+    async def request(self, op, pattern=None, limit=None):
+        """ Sends request and returns its response object """
+        self._next_id += 1
+        request = {"id": self._next_id, "op": op}
+        if pattern is not None:
+            request["pattern"] = pattern
+        if limit is not None:
+            request["limit"] = limit
+        future = asyncio.get_running_loop().create_future()
+        self._pending[self._next_id] = future
+        self._writer.write(json.dumps(request).encode('utf-8') + b'\n')
+        await self._writer.drain()
+        return await future
+
+    async def count(self, pattern):
+        return (await self.request("count", pattern))["count"]
+
+    async def locate(self, pattern, limit=None):
+        return (await self.request("locate", pattern, limit))["positions"]
+
+    async def metrics(self):
+        return (await self.request("metrics"))["metrics"]
+
+    async def _receive(self):
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                break
+            response = json.loads(line)
+            future = self._pending.pop(response.get("id"), None)
+            if future is not None and not future.done():
+                future.set_result(response)
+
+
+if __name__ == "__main__":
+    # create command line arguments parser
+    parser = argparse.ArgumentParser(description='Serve count and locate requests on BWT + FM index over TCP.')
+    parser.add_argument("-t", "--text", required=False, help="Path to text file. Index is built on start.")
+    parser.add_argument("-i", "--index", required=False, help="Path to index file written by index_file.py.")
+    parser.add_argument("--sa_factor", type=positive_int, default=1, required=False,
+                        help="Suffix array factor of index built from --text.")
+    parser.add_argument("--tally_factor", type=positive_int, default=1, required=False,
+                        help="Ranks tally matrix factor of index built from --text.")
+    parser.add_argument("--host", default="127.0.0.1", required=False, help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=default_port, required=False, help="Port to listen on.")
+    parser.add_argument("--batch_size", type=positive_int, default=max_batch_size, required=False,
+                        help="Largest number of requests searched together.")
+    parser.add_argument("--batch_delay", type=float, default=max_batch_delay * 1000, required=False,
+                        help="Milliseconds to wait for more requests before a batch is searched.")
+    parser.add_argument("--queue_size", type=positive_int, default=request_queue_size, required=False,
+                        help="Number of queued requests above which new requests are rejected as overloaded.")
+    parser.add_argument("--timeout", type=float, default=request_timeout, required=False,
+                        help="Seconds after which unanswered request is answered with timeout error.")
+    args = vars(parser.parse_args())
+    if bool(args["text"]) == bool(args["index"]):
+        parser.error("exactly one of -t/--text and -i/--index is required")
+
+    if args["index"]:
+        from index_file import load_index
+        fm_index = load_index(args["index"])
+    else:
+        with open(args["text"], 'r') as f:
+            text = ''.join(f.read().splitlines())
+        fm_index = create_fm_index(text, args["sa_factor"], args["tally_factor"])
+
+    async def main():
+        server = QueryServer(fm_index, args["batch_size"], args["batch_delay"] / 1000, args["queue_size"],
+                             args["timeout"])
+        port = await server.start(args["host"], args["port"])
+        print("Listening on %s:%d" % (args["host"], port), file=sys.stderr)
+        await server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
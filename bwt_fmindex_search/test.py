@@ -52,6 +52,28 @@ assert (suffix_array_manber_myers(text_with_blancs)) == [7, 4, 9, 0, 8, 11, 1, 5
     error_message_builder("suffix_array_manber_myers", "text_with_blancs")
 
 
+# Suffix_array_sais tests
+assert (suffix_array_sais(text_normal_1)) == [10, 7, 0, 3, 5, 8, 1, 4, 6, 9, 2], \
+    error_message_builder("suffix_array_sais", "text_normal_1")
+
+assert (suffix_array_sais(text_normal_2)) == [5, 3, 1, 0, 4, 2], \
+    error_message_builder("suffix_array_sais", "text_normal_2")
+
+assert (suffix_array_sais(text_repetitive)) == [1, 3, 5, 7, 9, 21, 19, 17, 15, 13, 11, 0, 2, 4, 6, 8, 20, 18,
+                                                16, 14, 12, 10], \
+    error_message_builder("suffix_array_sais", "text_normal_repetitive")
+
+assert (suffix_array_sais(text_empty)) == [], error_message_builder("suffix_array_sais", "text_empty")
+
+assert (suffix_array_sais(text_with_num)) == [8, 4, 7, 3, 0, 1, 6, 2, 5], \
+    error_message_builder("suffix_array_sais", "text_with_num")
+
+assert (suffix_array_sais(text_with_blancs)) == [7, 4, 9, 0, 8, 11, 1, 5, 2, 6, 3, 13, 10, 12], \
+    error_message_builder("suffix_array_sais", "text_with_blancs")
+
+assert (suffix_array_sais("ab" * 3000)) == suffix_array_best("ab" * 3000), \
+    error_message_builder("suffix_array_sais", "long repetitive text")
+
 # Test bucket sort
 assert(sort_bucket(text_normal_1, (i for i in range(len(text_normal_1))))) == [10, 7, 0, 3, 5, 8, 1, 4, 6, 9, 2]
 assert(sort_bucket(text_empty, (i for i in range(len(text_empty))))) == []
@@ -296,3 +318,593 @@ assert (query_fm_index.query(pattern_should_not_exist_3)) == [], \
     error_message_builder("query", "pattern_should_not_exist_3")
 assert (query_fm_index.query(pattern_empty)) == [], "should return empty array"
 
+
+# OPTIMIZED FM INDEX TESTS
+import fmindex_optimized
+
+f_column_optimized_2 = fmindex_optimized.create_f_column(text_normal_2_terminal)
+bwt_optimized_2 = fmindex_optimized.encode_bwt("annb" + '\0' + "aa", f_column_optimized_2)
+tally_optimized_2 = fmindex_optimized.create_tally(bwt_optimized_2, 2, len(f_column_optimized_2.alphabet))
+
+assert bwt_optimized_2 == bytes([1, 3, 3, 2, 0, 1, 1]), error_message_builder("encode_bwt", "text_normal_2")
+assert list(tally_optimized_2.ranks) == [0, 0, 0, 1, 1, 0, 1, 1, 2, 3, 0, 0, 1, 1, 1, 0, 1, 2, 2, 2], \
+    error_message_builder("create_tally", "text_normal_2")
+assert tally_optimized_2.rows == 5, error_message_builder("create_tally", "text_normal_2")
+
+optimized_fm_index_2 = fmindex_optimized.FMIndex(bwt_optimized_2, {}, tally_optimized_2, f_column_optimized_2)
+assert [tally_optimized_2.rank(3, i) for i in range(8)] == [0, 0, 1, 2, 2, 2, 2, 2], \
+    error_message_builder("Tally.rank", "text_normal_2")
+assert [optimized_fm_index_2._find_tally(i, 1) for i in range(8)] == [0, 1, 1, 1, 1, 1, 2, 3], \
+    error_message_builder("_find_tally", "text_normal_2")
+assert optimized_fm_index_2._find_preceders(1, 4, 3) == (0, 2), error_message_builder("_find_preceders", "text_normal_2")
+
+for sa_factor, tally_factor in [(1, 1), (3, 4), (16, 7)]:
+    optimized_query_fm_index = fmindex_optimized.create_fm_index(text_for_querying, sa_factor, tally_factor)
+    assert (optimized_query_fm_index.query(pattern_should_exist_1)) == [0], \
+        error_message_builder("optimized query", "pattern_should_exist_1")
+    assert (optimized_query_fm_index.query(pattern_should_exist_2)) == [43], \
+        error_message_builder("optimized query", "pattern_should_exist_2")
+    assert (optimized_query_fm_index.query(pattern_should_exist_3)) == [16], \
+        error_message_builder("optimized query", "pattern_should_exist_3")
+    assert sorted(optimized_query_fm_index.query(pattern_should_exist_4)) == [14, 35], \
+        error_message_builder("optimized query", "pattern_should_exist_4")
+    assert (optimized_query_fm_index.query(pattern_should_not_exist_1)) == [], \
+        error_message_builder("optimized query", "pattern_should_not_exist_1")
+    assert (optimized_query_fm_index.query(pattern_should_not_exist_2)) == [], \
+        error_message_builder("optimized query", "pattern_should_not_exist_2")
+    assert (optimized_query_fm_index.query(pattern_should_not_exist_3)) == [], \
+        error_message_builder("optimized query", "pattern_should_not_exist_3")
+    assert (optimized_query_fm_index.query(pattern_empty)) == [], "should return empty array"
+
+# Test bit vector rank
+import bitvector
+
+bit_vector = bitvector.create_bit_vector([0, 3, 8, 9, 700], 1000)
+assert [bit_vector[i] for i in range(11)] == [1, 0, 0, 1, 0, 0, 0, 0, 1, 1, 0], \
+    error_message_builder("create_bit_vector", "bits")
+assert [bit_vector.rank(i) for i in [0, 1, 4, 9, 10, 700, 701, 1000]] == [0, 1, 2, 3, 4, 4, 5, 5], \
+    error_message_builder("BitVector.rank", "ranks")
+
+# Test index file round trip
+import os
+import tempfile
+import index_file
+
+with tempfile.TemporaryDirectory() as index_directory:
+    index_path = os.path.join(index_directory, "query.fmi")
+    index_file.save_index(fmindex_optimized.create_fm_index(text_for_querying, 4, 8), index_path)
+    loaded_fm_index = index_file.load_index(index_path)
+    assert (loaded_fm_index.query(pattern_should_exist_1)) == [0], \
+        error_message_builder("load_index", "pattern_should_exist_1")
+    assert sorted(loaded_fm_index.query(pattern_should_exist_4)) == [14, 35], \
+        error_message_builder("load_index", "pattern_should_exist_4")
+    assert (loaded_fm_index.query(pattern_should_not_exist_2)) == [], \
+        error_message_builder("load_index", "pattern_should_not_exist_2")
+    del loaded_fm_index
+
+# Test batched query
+many_patterns = [pattern_should_exist_1, pattern_should_not_exist_1, pattern_should_exist_4, pattern_empty,
+                 pattern_should_exist_2, pattern_should_exist_4, "Abyssus abyssum invocat. Cave ab homine unius libri!"]
+many_intervals = optimized_query_fm_index.query_many(many_patterns)
+assert many_intervals == [optimized_query_fm_index._backward_search(pattern) for pattern in many_patterns], \
+    error_message_builder("query_many", "mixed patterns")
+assert [end - start for start, end in many_intervals] == [1, 0, 2, 0, 1, 2, 0], \
+    error_message_builder("query_many", "mixed patterns")
+assert optimized_query_fm_index.query_many([]) == [], error_message_builder("query_many", "no patterns")
+
+# Test count and locate
+assert optimized_query_fm_index.count(pattern_should_exist_4) == 2, error_message_builder("count", "pattern_should_exist_4")
+assert optimized_query_fm_index.count(pattern_should_not_exist_1) == 0, \
+    error_message_builder("count", "pattern_should_not_exist_1")
+assert optimized_query_fm_index.count(pattern_empty) == 0, error_message_builder("count", "pattern_empty")
+assert sorted(optimized_query_fm_index.locate("s")) == [3, 4, 6, 11, 12, 44], error_message_builder("locate", "s")
+assert len(list(optimized_query_fm_index.locate("s", limit=3))) == 3, error_message_builder("locate", "limit")
+assert next(optimized_query_fm_index.locate(pattern_should_exist_3)) == 16, \
+    error_message_builder("locate", "pattern_should_exist_3")
+assert list(optimized_query_fm_index.locate(pattern_should_not_exist_3)) == [], \
+    error_message_builder("locate", "pattern_should_not_exist_3")
+assert optimized_query_fm_index.locate_sorted("s") == [3, 4, 6, 11, 12, 44], error_message_builder("locate_sorted", "s")
+assert optimized_query_fm_index.locate_sorted("s", limit=2) == [3, 4], error_message_builder("locate_sorted", "limit")
+
+# Test locating with sparse suffix array sample, LF walks are longer than recursion limit
+sparse_text = "abracadabra" * 300
+sparse_fm_index = fmindex_optimized.create_fm_index(sparse_text, 5000, 16)
+assert sparse_fm_index.locate_sorted("cadabra") == list(range(4, len(sparse_text), 11)), \
+    error_message_builder("locate_sorted", "sparse suffix array sample")
+assert sparse_fm_index._find_suffix(1) == sparse_fm_index._find_suffixes([1])[0], \
+    error_message_builder("_find_suffix", "sparse suffix array sample")
+
+# Test parallel querying
+parallel_patterns = [pattern_should_exist_1, pattern_should_exist_4, pattern_should_not_exist_1, pattern_empty] * 5
+assert query_in_parallel(query_fm_index, parallel_patterns, 2) == \
+       [query_fm_index.query(pattern) for pattern in parallel_patterns], \
+    error_message_builder("query_in_parallel", "forked workers")
+import multiprocessing
+
+get_all_start_methods = multiprocessing.get_all_start_methods
+multiprocessing.get_all_start_methods = lambda: ["spawn"]
+try:
+    query_in_parallel(query_fm_index, parallel_patterns, 2)
+    assert False, error_message_builder("query_in_parallel", "no fork start method")
+except RuntimeError:
+    pass
+finally:
+    multiprocessing.get_all_start_methods = get_all_start_methods
+
+with tempfile.TemporaryDirectory() as index_directory:
+    index_path = os.path.join(index_directory, "query.fmi")
+    index_file.save_index(optimized_query_fm_index, index_path)
+    assert index_file.query_in_parallel(index_path, parallel_patterns, 2) == \
+           [optimized_query_fm_index.query(pattern) for pattern in parallel_patterns], \
+        error_message_builder("query_in_parallel", "memory mapped index file")
+
+# index built by fmindex_optimized run as a script has its own copies of classes
+import importlib.util
+
+script_spec = importlib.util.spec_from_file_location("__main__copy", fmindex_optimized.__file__)
+script_module = importlib.util.module_from_spec(script_spec)
+script_spec.loader.exec_module(script_module)
+with tempfile.TemporaryDirectory() as index_directory:
+    index_path = os.path.join(index_directory, "script.fmi")
+    index_file.save_index(script_module.create_fm_index(text_for_querying, 4, 8), index_path)
+    assert sorted(index_file.load_index(index_path).query(pattern_should_exist_4)) == [14, 35], \
+        error_message_builder("save_index", "index built by script")
+for backend in ["wavelet", "directory", "dna"]:
+    assert not fmindex_optimized.has_sampled_tally(fmindex_optimized.create_fm_index(text_for_querying, 4, 8, backend=backend)), \
+        error_message_builder("has_sampled_tally", backend)
+
+# Test wavelet matrix backend
+import wavelet
+
+wavelet_codes = [3, 0, 5, 5, 1, 6, 3, 3, 2, 0]
+wavelet_matrix = wavelet.create_wavelet_matrix(wavelet_codes, 7)
+assert [wavelet_matrix[i] for i in range(len(wavelet_codes))] == wavelet_codes, \
+    error_message_builder("WaveletMatrix access", "wavelet_codes")
+assert all(wavelet_matrix.rank(code, i) == wavelet_codes[:i].count(code) for code in range(8) for i in range(11)), \
+    error_message_builder("WaveletMatrix.rank", "wavelet_codes")
+
+wavelet_fm_index = fmindex_optimized.create_fm_index(text_for_querying, 3, 1, backend="wavelet")
+assert (wavelet_fm_index.query(pattern_should_exist_2)) == [43], \
+    error_message_builder("wavelet query", "pattern_should_exist_2")
+assert sorted(wavelet_fm_index.query(pattern_should_exist_4)) == [14, 35], \
+    error_message_builder("wavelet query", "pattern_should_exist_4")
+assert (wavelet_fm_index.query(pattern_should_not_exist_1)) == [], \
+    error_message_builder("wavelet query", "pattern_should_not_exist_1")
+
+# Test run-length FM index
+import rlfmindex
+
+repetitive_collection = "abracadabra" * 20 + "abracadabro" + "abracadabra" * 20
+rlfm_index = rlfmindex.create_rlfm_index(repetitive_collection)
+assert len(rlfm_index._run_starts) < len(repetitive_collection) // 10, \
+    error_message_builder("create_rlfm_index", "number of runs")
+assert rlfm_index.locate_sorted("abracadabro") == [220], error_message_builder("RLFMIndex.locate", "abracadabro")
+assert rlfm_index.locate_sorted("cadabra") == [i for i in range(4, len(repetitive_collection), 11) if i != 224], \
+    error_message_builder("RLFMIndex.locate", "cadabra")
+assert rlfm_index.count("abra") == 81, error_message_builder("RLFMIndex.count", "abra")
+assert rlfm_index.count(pattern_should_not_exist_1) == 0, error_message_builder("RLFMIndex.count", "pattern_should_not_exist_1")
+assert len(list(rlfm_index.locate("a", limit=5))) == 5, error_message_builder("RLFMIndex.locate", "limit")
+
+rlfm_query_index = rlfmindex.create_rlfm_index(text_for_querying)
+assert (rlfm_query_index.query(pattern_should_exist_1)) == [0], \
+    error_message_builder("RLFMIndex.query", "pattern_should_exist_1")
+assert sorted(rlfm_query_index.query(pattern_should_exist_4)) == [14, 35], \
+    error_message_builder("RLFMIndex.query", "pattern_should_exist_4")
+assert (rlfm_query_index.query(pattern_empty)) == [], error_message_builder("RLFMIndex.query", "pattern_empty")
+periodic_rlfm_index = rlfmindex.create_rlfm_index("abcabc")
+periodic_fm_index = fmindex_optimized.create_fm_index("abcabc", 2, 2)
+for pattern in [terminal_char, terminal_char + "ab", "c" + terminal_char]:
+    assert periodic_rlfm_index.query(pattern) == periodic_fm_index.query(pattern), \
+        error_message_builder("RLFMIndex.query", repr(pattern))
+
+# Test FASTA and FASTQ reading
+import io
+import fasta
+
+fasta_text, fasta_records = fasta.read_sequences(io.BytesIO(b">chr1 first\nACGTac\nGT\n\n>chr2\nTTAG\n"))
+assert fasta_text == "ACGTACGT" + fasta.record_separator + "TTAG", error_message_builder("read_sequences", "fasta")
+assert fasta_records.names == ["chr1", "chr2"], error_message_builder("read_sequences", "fasta names")
+assert [fasta_records.locate(i) for i in [0, 7, 9, 12]] == [(0, 0), (0, 7), (1, 0), (1, 3)], \
+    error_message_builder("RecordTable.locate", "fasta")
+
+fastq_text, fastq_records = fasta.read_sequences(io.BytesIO(b"@read1\nACGT\n+\n@@II\n@read2\nGG\n+read2\n@I\n"))
+assert fastq_text == "ACGT" + fasta.record_separator + "GG", error_message_builder("read_sequences", "fastq")
+assert fastq_records.names == ["read1", "read2"], error_message_builder("read_sequences", "fastq names")
+
+fasta_fm_index = fmindex_optimized.create_fm_index(fasta_text, 2, 2)
+assert fasta_fm_index.query("GTTT") == [], error_message_builder("read_sequences", "match spanning two records")
+assert [fasta_records.locate(position) for position in fasta_fm_index.locate_sorted("TA")] == [(0, 3), (1, 1)], \
+    error_message_builder("RecordTable.locate", "hits")
+
+# Test external memory index construction
+import external
+import random
+import tracemalloc
+
+with tempfile.TemporaryDirectory() as index_directory:
+    text_path = os.path.join(index_directory, "text.txt")
+    index_path = os.path.join(index_directory, "external.fmi")
+    with open(text_path, 'w') as f:
+        f.write(text_for_querying[:30] + "\n" + text_for_querying[30:])
+    # budget of a few suffixes per chunk forces a multi way merge
+    external.build_index_file(text_path, index_path, 4, 8, 8 * external.bytes_per_sorted_suffix)
+    external_fm_index = index_file.load_index(index_path)
+    in_memory_fm_index = fmindex_optimized.create_fm_index(text_for_querying, 4, 8)
+    assert bytes(external_fm_index._bwt) == bytes(in_memory_fm_index._bwt), error_message_builder("build_index_file", "bwt")
+    for pattern in [pattern_should_exist_1, pattern_should_exist_4, pattern_should_not_exist_2, "a", "s"]:
+        assert sorted(external_fm_index.query(pattern)) == sorted(in_memory_fm_index.query(pattern)), \
+            error_message_builder("build_index_file", pattern)
+    del external_fm_index
+    # two suffixes per chunk give more runs than are merged at once, so runs are merged in several passes
+    external.build_index_file(text_path, index_path, 4, 8, 2 * external.bytes_per_sorted_suffix)
+    external_fm_index = index_file.load_index(index_path)
+    assert bytes(external_fm_index._bwt) == bytes(in_memory_fm_index._bwt), \
+        error_message_builder("build_index_file", "multi pass merge")
+    del external_fm_index
+
+    # non ASCII characters and all line breaks split on by splitlines are handled like in memory
+    with open(text_path, 'w') as f:
+        f.write("café na\r\ncajanku\x0bcafé\u2028!")
+    with open(text_path, 'r') as f:
+        in_memory_fm_index = fmindex_optimized.create_fm_index(''.join(f.read().splitlines()), 2, 2)
+    external.build_index_file(text_path, index_path, 2, 2, 4 * external.bytes_per_sorted_suffix)
+    external_fm_index = index_file.load_index(index_path)
+    assert sorted(external_fm_index.query("café")) == sorted(in_memory_fm_index.query("café")) == [0, 14], \
+        error_message_builder("build_index_file", "café")
+    assert external_fm_index.query("na") == in_memory_fm_index.query("na") == [5], \
+        error_message_builder("build_index_file", "line breaks")
+    del external_fm_index
+    with open(text_path, 'w') as f:
+        f.write("café na čajanku")
+    try:
+        external.build_index_file(text_path, index_path, 2, 2, 4 * external.bytes_per_sorted_suffix)
+        assert False, error_message_builder("build_index_file", "character above U+00FF")
+    except ValueError:
+        pass
+
+    # one tally stream per symbol of a large alphabet still has to fit in memory budget
+    large_alphabet_generator = random.Random(7)
+    with open(text_path, 'w') as f:
+        f.write(''.join(chr(large_alphabet_generator.randrange(33, 256)) for _ in range(20000)))
+    memory_budget = 1000000
+    tracemalloc.start()
+    external.build_index_file(text_path, index_path, 4, 1, memory_budget)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert peak_memory <= memory_budget, error_message_builder("build_index_file", "large alphabet memory budget")
+
+periodic_text = b"ab" * external.compare_window_size * 3 + b"\0"
+assert external.compare_suffixes(periodic_text, 0, 2) == 1 and external.compare_suffixes(periodic_text, 2, 0) == -1 and \
+    external.compare_suffixes(periodic_text, 4, 4) == 0, error_message_builder("compare_suffixes", "periodic_text")
+
+# Test approximate query
+def approx_positions(fm_index, intervals):
+    return sorted((position, differences) for start, end, differences in intervals
+                  for position in fm_index._find_suffixes(range(start, end)))
+
+
+assert approx_positions(optimized_query_fm_index, optimized_query_fm_index.query_approx("Abyxsus", 1)) == [(0, 1)], \
+    error_message_builder("query_approx", "one mismatch")
+assert approx_positions(optimized_query_fm_index, optimized_query_fm_index.query_approx("abyssus", 1)) == [(0, 1), (8, 1)], \
+    error_message_builder("query_approx", "case mismatch")
+assert len(text_for_querying) not in [position for position, _ in approx_positions(
+    optimized_query_fm_index, optimized_query_fm_index.query_approx("a", 1, 1))], \
+    error_message_builder("query_approx", "whole pattern deleted")
+assert optimized_query_fm_index.query_approx(pattern_should_not_exist_2, 1) == [], \
+    error_message_builder("query_approx", "pattern_should_not_exist_2 mismatches")
+assert approx_positions(optimized_query_fm_index, optimized_query_fm_index.query_approx(pattern_should_not_exist_2, 0, 1)) \
+    == [(43, 1)], error_message_builder("query_approx", "pattern_should_not_exist_2 edits")
+assert approx_positions(optimized_query_fm_index, optimized_query_fm_index.query_approx("abyss", 0)) == [(8, 0)], \
+    error_message_builder("query_approx", "exact")
+assert optimized_query_fm_index.query_approx(pattern_empty, 2) == [], error_message_builder("query_approx", "pattern_empty")
+
+# Test bidirectional FM index
+import bidirectional
+
+bidirectional_fm_index = bidirectional.create_bidirectional_fm_index(text_for_querying, 4, 8)
+abyss_interval = bidirectional_fm_index.interval().extend_left("y").extend_right("s").extend_left("b").extend_right("s")
+assert abyss_interval.forward_range() == optimized_query_fm_index._backward_search("byss"), \
+    error_message_builder("BidirectionalInterval", "forward interval")
+assert abyss_interval.reverse_range() == bidirectional_fm_index.reverse._backward_search("ssyb"), \
+    error_message_builder("BidirectionalInterval", "reverse interval")
+assert sorted(abyss_interval.locate()) == [1, 9], error_message_builder("BidirectionalInterval.locate", "byss")
+assert sorted(abyss_interval.extend_right("u").extend_left("A").locate()) == [0], \
+    error_message_builder("BidirectionalInterval.extend_left", "Abyssu")
+assert len(abyss_interval.extend_right("x")) == 0, error_message_builder("BidirectionalInterval.extend_right", "byssx")
+assert sorted(bidirectional_fm_index.query(pattern_should_exist_4)) == [14, 35], \
+    error_message_builder("BidirectionalFMIndex.query", "pattern_should_exist_4")
+assert bidirectional_fm_index.count(pattern_should_not_exist_2) == 0, \
+    error_message_builder("BidirectionalFMIndex.count", "pattern_should_not_exist_2")
+
+# Test batch planner
+import batch
+
+batch_planner = batch.BatchPlanner(optimized_query_fm_index, cache_size=64)
+assert batch_planner.query_intervals(many_patterns) == many_intervals, \
+    error_message_builder("BatchPlanner.query_intervals", "mixed patterns")
+first_batch_steps = batch_planner.stats()["steps"]
+assert batch_planner.query(many_patterns) == [optimized_query_fm_index.query(pattern) for pattern in many_patterns], \
+    error_message_builder("BatchPlanner.query", "mixed patterns")
+assert batch_planner.stats()["steps"] == first_batch_steps and batch_planner.stats()["cache_hits"] > 0, \
+    error_message_builder("BatchPlanner", "cached batch")
+shared_suffix_patterns = ["abyssum", "Abyssum", "yssum", "ssum"]
+shared_suffix_planner = batch.BatchPlanner(optimized_query_fm_index)
+assert shared_suffix_planner.query_intervals(shared_suffix_patterns) == \
+    [optimized_query_fm_index._backward_search(pattern) for pattern in shared_suffix_patterns], \
+    error_message_builder("BatchPlanner.query_intervals", "shared suffixes")
+# one step per character of "abyssum" and one for "A"
+assert shared_suffix_planner.stats()["steps"] == 8, error_message_builder("BatchPlanner", "shared suffix steps")
+branching_fm_index = fmindex_optimized.create_fm_index("aaabaa", 2, 2)
+branching_planner = batch.BatchPlanner(branching_fm_index)
+branching_patterns = ["aaa", "baa", "ba"]
+assert branching_planner.query_intervals(branching_patterns) == \
+    [branching_fm_index._backward_search(pattern) for pattern in branching_patterns], \
+    error_message_builder("BatchPlanner.query_intervals", "branching patterns")
+# reversed patterns "aaa", "aab" and "ab" share node "a", so one step per edge of their trie
+assert branching_planner.stats()["steps"] == 5, error_message_builder("BatchPlanner", "branching steps")
+assert batch.common_prefix_length("abc", "abd") == 2, error_message_builder("common_prefix_length", "abc abd")
+
+# Test k-mer interval table
+kmer_fm_index = fmindex_optimized.create_fm_index(text_for_querying, 4, 8, kmer_length=3)
+assert kmer_fm_index._kmer_table.offsets == [0, 0, 20, 20 + 20 ** 2], error_message_builder("create_kmer_table", "offsets")
+for pattern in many_patterns + ["s", "ss", "sus", "ssus", "xyz", "Ab"]:
+    assert kmer_fm_index._backward_search(pattern) == optimized_query_fm_index._backward_search(pattern), \
+        error_message_builder("KmerTable", pattern)
+assert kmer_fm_index._kmer_table.lookup([0, 1]) is None, error_message_builder("KmerTable.lookup", "terminal")
+try:
+    fmindex_optimized.create_kmer_table(kmer_fm_index._tally, kmer_fm_index._f_column, -1)
+    assert False, error_message_builder("create_kmer_table", "negative length")
+except ValueError:
+    pass
+assert sorted(kmer_fm_index.query(pattern_should_exist_4)) == [14, 35], \
+    error_message_builder("KmerTable", "pattern_should_exist_4")
+with tempfile.TemporaryDirectory() as index_directory:
+    index_path = os.path.join(index_directory, "kmer.fmi")
+    index_file.save_index(kmer_fm_index, index_path)
+    loaded_kmer_fm_index = index_file.load_index(index_path)
+    assert loaded_kmer_fm_index._kmer_table is not None and \
+        list(loaded_kmer_fm_index._kmer_table.starts) == list(kmer_fm_index._kmer_table.starts), \
+        error_message_builder("load_index", "kmer table")
+    assert loaded_kmer_fm_index.query_many(many_patterns) == many_intervals, error_message_builder("load_index", "kmer query_many")
+    del loaded_kmer_fm_index
+
+# Test benchmark suite helpers
+import benchmark
+
+for corpus in benchmark.suite_corpora:
+    assert benchmark.generate_corpus(corpus, 300, 7) == benchmark.generate_corpus(corpus, 300, 7), \
+        error_message_builder("generate_corpus", corpus + " seed")
+    assert len(benchmark.generate_corpus(corpus, 300, 7)) == 300, error_message_builder("generate_corpus", corpus + " length")
+assert len(set(benchmark.generate_corpus("large_alphabet", 3000, 7))) > 256, \
+    error_message_builder("generate_corpus", "large_alphabet size")
+benchmark_patterns = benchmark.generate_patterns(text_for_querying, 6, 4, 7)
+assert all(pattern in text_for_querying for pattern in benchmark_patterns[::2]), \
+    error_message_builder("generate_patterns", "substrings")
+assert benchmark.percentile([1, 2, 3, 4], 50) == 2 and benchmark.percentile([1, 2, 3, 4], 99) == 4, \
+    error_message_builder("percentile", "nearest rank")
+baseline_report = {"results": [{"corpus": "dna", "backend": "tally", "sa_factor": 4, "tally_factor": 8, "length": 10,
+                                "patterns": 1, "pattern_length": 1, "seed": 0, "build_seconds": 1.0,
+                                "queries_per_second": 100.0}]}
+slower_report = {"results": [dict(baseline_report["results"][0], build_seconds=1.1, queries_per_second=50.0)]}
+assert len(benchmark.compare_with_baseline(slower_report, baseline_report, 0.2)) == 1, \
+    error_message_builder("compare_with_baseline", "slower queries")
+assert benchmark.compare_with_baseline(baseline_report, baseline_report, 0.2) == [], \
+    error_message_builder("compare_with_baseline", "same report")
+
+# Test memory report
+memory_report = optimized_query_fm_index.memory_report()
+assert memory_report["bwt"] == len(text_for_querying) + 1, error_message_builder("memory_report", "bwt")
+assert memory_report["tally"] == len(optimized_query_fm_index._tally.ranks) * optimized_query_fm_index._tally.ranks.itemsize, \
+    error_message_builder("memory_report", "tally")
+assert memory_report["total"] == sum(size for name, size in memory_report.items() if name != "total"), \
+    error_message_builder("memory_report", "total")
+assert kmer_fm_index.memory_report()["kmer_table"] > 0, error_message_builder("memory_report", "kmer_table")
+wavelet_memory_report = fmindex_optimized.create_fm_index(text_for_querying, 4, 8, backend="wavelet").memory_report()
+assert wavelet_memory_report["bwt"] == 0 and wavelet_memory_report["tally"] > 0, \
+    error_message_builder("memory_report", "wavelet")
+assert rlfm_index.memory_report()["total"] > 0, error_message_builder("RLFMIndex.memory_report", "total")
+assert bidirectional_fm_index.memory_report()["total"] > memory_report["total"], \
+    error_message_builder("BidirectionalFMIndex.memory_report", "total")
+
+# Test instrumentation
+import instrumentation
+
+instrumented_fm_index = instrumentation.instrument(optimized_query_fm_index, history_size=2)
+assert sorted(instrumented_fm_index.query(pattern_should_exist_4)) == [14, 35], \
+    error_message_builder("InstrumentedFMIndex.query", "pattern_should_exist_4")
+assert instrumented_fm_index.count(pattern_should_exist_1) == 1, error_message_builder("InstrumentedFMIndex.count", "pattern_should_exist_1")
+assert instrumented_fm_index.query(pattern_should_not_exist_1) == [], \
+    error_message_builder("InstrumentedFMIndex.query", "pattern_should_not_exist_1")
+instrumentation_stats = instrumented_fm_index.stats()
+assert instrumentation_stats["queries"] == 3 and len(instrumented_fm_index.history) == 2, \
+    error_message_builder("InstrumentedFMIndex", "history")
+assert instrumented_fm_index.history[0]["backward_steps"] == len(pattern_should_exist_1) - 1, \
+    error_message_builder("InstrumentedFMIndex", "backward steps")
+assert instrumentation_stats["interval_width"] == 3 and instrumentation_stats["located_rows"] == 2, \
+    error_message_builder("InstrumentedFMIndex", "interval widths")
+assert sum(instrumentation_stats["lf_walks"].values()) == 2, error_message_builder("InstrumentedFMIndex", "lf walks")
+assert instrumentation_stats["lf_steps"] == sum(steps * rows for steps, rows in instrumentation_stats["lf_walks"].items()), \
+    error_message_builder("InstrumentedFMIndex", "lf steps")
+assert instrumentation_stats["rank_lookups"] >= 2 * instrumentation_stats["backward_steps"], \
+    error_message_builder("InstrumentedFMIndex", "rank lookups")
+assert "scanned_characters" in instrumentation_stats, error_message_builder("InstrumentedFMIndex", "scanned characters")
+previous_record = dict(instrumented_fm_index.history[-1])
+assert instrumented_fm_index.query_many(many_patterns) == many_intervals, \
+    error_message_builder("InstrumentedFMIndex.query_many", "many_patterns")
+assert dict(instrumented_fm_index.history[-2]) == previous_record and \
+    instrumented_fm_index.history[-1]["patterns"] == len(many_patterns) and \
+    instrumented_fm_index.history[-1]["rank_lookups"] > 0, \
+    error_message_builder("InstrumentedFMIndex.query_many", "history record")
+assert instrumented_fm_index.stats()["queries"] == 3 + len(many_patterns), \
+    error_message_builder("InstrumentedFMIndex.query_many", "queries")
+
+# Test factor tuner
+for sa_factor, tally_factor in [(1, 1), (4, 8), (5000, 3)]:
+    assert benchmark.predict_memory_report(len(text_for_querying) + 1, optimized_query_fm_index._f_column, sa_factor, tally_factor) == \
+        fmindex_optimized.create_fm_index(text_for_querying, sa_factor, tally_factor).memory_report(), \
+        error_message_builder("predict_memory_report", "%d %d" % (sa_factor, tally_factor))
+tuned_factors, tuning_candidates = benchmark.tune_factors(text_for_querying, many_patterns, 3000, repeats=1)
+assert tuned_factors in [(candidate["sa_factor"], candidate["tally_factor"]) for candidate in tuning_candidates], \
+    error_message_builder("tune_factors", "chosen candidate")
+assert all(candidate["memory_bytes"] <= 3000 for candidate in tuning_candidates), \
+    error_message_builder("tune_factors", "memory budget")
+assert benchmark.tune_factors(text_for_querying, many_patterns, 10) == (None, []), \
+    error_message_builder("tune_factors", "budget too small")
+
+# Test appending documents
+import incremental
+
+appended_fm_index = incremental.append_document(optimized_query_fm_index, "Ab ovo usque ad mala")
+second_document_start = len(text_for_querying) + 1
+assert sorted(appended_fm_index.query("Ab")) == [0, second_document_start], error_message_builder("append_document", "Ab")
+assert sorted(appended_fm_index.query(pattern_should_exist_4)) == [14, 35, second_document_start + 16], \
+    error_message_builder("append_document", "pattern_should_exist_4")
+assert appended_fm_index.query("ovo") == [second_document_start + 3], error_message_builder("append_document", "ovo")
+assert appended_fm_index.query("libriAb") == [], error_message_builder("append_document", "match across documents")
+appended_fm_index = incremental.append_document(appended_fm_index, "Qui bene amat, bene castigat")
+assert appended_fm_index.count("bene") == 2 and appended_fm_index.count("Q") == 1, \
+    error_message_builder("append_document", "new character")
+assert sorted(appended_fm_index.query("a")) == \
+    [i for i, c in enumerate(text_for_querying + "\0Ab ovo usque ad mala\0Qui bene amat, bene castigat") if c == "a"], \
+    error_message_builder("append_document", "a")
+
+# Test query server
+import asyncio
+import server
+
+
+async def exercise_query_server():
+    query_server = server.QueryServer(optimized_query_fm_index, batch_delay=0.01)
+    port = await query_server.start(port=0)
+    client = server.QueryClient()
+    await client.connect(port=port)
+    counts = await asyncio.gather(*[client.count(pattern) for pattern in many_patterns])
+    assert counts == [end - start for start, end in many_intervals], error_message_builder("QueryServer", "count")
+    assert sorted(await client.locate(pattern_should_exist_4)) == [14, 35], error_message_builder("QueryServer", "locate")
+    assert len(await client.locate("s", limit=2)) == 2, error_message_builder("QueryServer", "locate limit")
+    assert "error" in await client.request("count"), error_message_builder("QueryServer", "bad request")
+    metrics = await client.metrics()
+    assert metrics["completed"] == len(many_patterns) + 2 and metrics["errors"] == {"bad_request": 1}, \
+        error_message_builder("QueryServer", "metrics")
+    assert metrics["batches"] < metrics["completed"], error_message_builder("QueryServer", "micro-batches")
+    await client.close()
+    await query_server.close()
+
+    overloaded_server = server.QueryServer(optimized_query_fm_index, queue_size=1, timeout=0)
+    port = await overloaded_server.start(port=0)
+    client = server.QueryClient()
+    await client.connect(port=port)
+    responses = await asyncio.gather(*[client.request("count", "a") for _ in range(10)])
+    assert {response["error"] for response in responses} <= {"overloaded", "timeout"}, \
+        error_message_builder("QueryServer", "overloaded and timeout")
+    await client.close()
+    await overloaded_server.close()
+
+
+asyncio.run(exercise_query_server())
+
+# Test packed DNA backend
+import dna
+
+dna_codes = [1, 3, 0, 2, 2, 4, 5, 1, 1, 3, 5, 2, 4, 4, 1]
+packed_dna = dna.create_packed_dna(dna_codes, 6, 4)
+assert [packed_dna[i] for i in range(len(dna_codes))] == dna_codes, error_message_builder("PackedDNA access", "dna_codes")
+assert all(packed_dna.rank(code, i) == dna_codes[:i].count(code) for code in range(7) for i in range(16)), \
+    error_message_builder("PackedDNA.rank", "dna_codes")
+
+dna_text = "ACGTNACGGTTACANNCGTAGGACTTAGCAN" * 5
+dna_fm_index = fmindex_optimized.create_fm_index(dna_text, 3, 5, backend="dna")
+assert sorted(dna_fm_index.query("TAG")) == [i for i in range(len(dna_text)) if dna_text.startswith("TAG", i)], \
+    error_message_builder("packed DNA query", "TAG")
+assert sorted(dna_fm_index.query("ANN")) == [i for i in range(len(dna_text)) if dna_text.startswith("ANN", i)], \
+    error_message_builder("packed DNA query", "ANN")
+assert dna_fm_index.query("GATTACA") == [], error_message_builder("packed DNA query", "GATTACA")
+tally_memory_report = fmindex_optimized.create_fm_index(dna_text, 3, 5).memory_report()
+assert dna_fm_index.memory_report()["bwt"] == 0 and \
+    dna_fm_index.memory_report()["tally"] < tally_memory_report["bwt"] + tally_memory_report["tally"], \
+    error_message_builder("memory_report", "packed DNA")
+
+# Test rank directory backend
+directory_codes = bytes([2, 0, 1, 1, 2, 2, 2, 1, 0, 2] * 60)
+rank_directory = fmindex_optimized.create_rank_directory(directory_codes, 3, 3)
+assert rank_directory.blocks.typecode == 'B' and rank_directory.blocks_per_superblock == 86, \
+    error_message_builder("create_rank_directory", "directory_codes")
+assert all(rank_directory.rank(code, i) == directory_codes[:i].count(code) for code in range(3) for i in range(601)), \
+    error_message_builder("RankDirectory.rank", "directory_codes")
+assert rank_directory.rank_many(range(601), [1] * 601) == [directory_codes[:i].count(1) for i in range(601)], \
+    error_message_builder("RankDirectory.rank_many", "directory_codes")
+
+directory_fm_index = fmindex_optimized.create_fm_index(text_for_querying, 3, 2, backend="directory")
+assert (directory_fm_index.query(pattern_should_exist_2)) == [43], \
+    error_message_builder("rank directory query", "pattern_should_exist_2")
+assert sorted(directory_fm_index.query(pattern_should_exist_4)) == [14, 35], \
+    error_message_builder("rank directory query", "pattern_should_exist_4")
+assert directory_fm_index.query_many(many_patterns) == many_intervals, \
+    error_message_builder("rank directory query_many", "many_patterns")
+
+# Test text extraction
+extracting_fm_index = fmindex_optimized.create_fm_index(text_for_querying, 4, 8, isa_factor=5)
+assert extracting_fm_index.extract(0, len(text_for_querying)) == text_for_querying, \
+    error_message_builder("extract", "whole text")
+assert extracting_fm_index.extract(8, 6) == "abyssu" and extracting_fm_index.extract(47, 10) == "ibri", \
+    error_message_builder("extract", "ranges")
+assert extracting_fm_index.extract_many([(0, 3), (2, 5), (len(text_for_querying), 3)]) == ["Aby", "yssus", ""], \
+    error_message_builder("extract_many", "overlapping ranges")
+assert extracting_fm_index.snippets(extracting_fm_index.query(pattern_should_exist_4), 2, 4) == \
+    [text_for_querying[p - 2:p + 4] for p in extracting_fm_index.query(pattern_should_exist_4)], \
+    error_message_builder("snippets", "pattern_should_exist_4")
+try:
+    optimized_query_fm_index.extract(0, 1)
+    assert False, error_message_builder("extract", "no isa sample")
+except ValueError:
+    pass
+
+appended_fm_index = incremental.append_document(extracting_fm_index, "Ab ovo usque ad mala")
+appended_text = text_for_querying + "\0Ab ovo usque ad mala"
+assert appended_fm_index.extract(40, 30) == appended_text[40:70], error_message_builder("extract", "appended document")
+assert appended_fm_index.snippet(len(text_for_querying) + 4, 10, 6) == "Ab ovo us", \
+    error_message_builder("snippet", "appended document")
+with tempfile.TemporaryDirectory() as index_directory:
+    index_path = os.path.join(index_directory, "extracting.fmi")
+    index_file.save_index(extracting_fm_index, index_path)
+    assert index_file.load_index(index_path).extract(20, 12) == text_for_querying[20:32], \
+        error_message_builder("extract", "index file")
+
+# Test bulk index construction
+construction_text = fmindex_optimized.terminate_string(text_for_querying * 3)
+construction_sa = fmindex_optimized.suffix_array_sais(construction_text)
+construction_f_column = fmindex_optimized.create_f_column(construction_text)
+construction_bwt = fmindex_optimized.create_encoded_bwt(construction_text, construction_sa, construction_f_column)
+assert construction_bwt == fmindex_optimized.encode_bwt(
+    fmindex_optimized.bw_transform(construction_text, construction_sa), construction_f_column), \
+    error_message_builder("create_encoded_bwt", "construction_text")
+large_alphabet_text = fmindex_optimized.terminate_string(''.join(chr(0x100 + i * 7 % 300) for i in range(900)))
+large_alphabet_sa = fmindex_optimized.suffix_array_sais(large_alphabet_text)
+large_alphabet_f_column = fmindex_optimized.create_f_column(large_alphabet_text)
+assert fmindex_optimized.create_encoded_bwt(large_alphabet_text, large_alphabet_sa, large_alphabet_f_column) == \
+    fmindex_optimized.encode_bwt(fmindex_optimized.bw_transform(large_alphabet_text, large_alphabet_sa), large_alphabet_f_column), \
+    error_message_builder("create_encoded_bwt", "large_alphabet_text")
+assert fmindex_optimized.create_encoded_bwt("\0", [0], fmindex_optimized.create_f_column("\0")) == bytes([0]), \
+    error_message_builder("create_encoded_bwt", "empty text")
+
+bit_flags = bytes([1, 0, 0, 1, 1, 0, 1, 0, 1, 1, 1])
+assert bitvector.pack_bits(bit_flags) == bitvector.create_bit_vector([i for i in range(len(bit_flags)) if bit_flags[i]], len(bit_flags)).bits, \
+    error_message_builder("pack_bits", "bit_flags")
+
+for factor in [1, 3, 15, 16, 17, 40]:
+    sampled = [i for i in range(len(construction_sa)) if construction_sa[i] % factor == 0]
+    assert fmindex_optimized.sampled_rows(construction_sa, factor) == \
+        bytes(int(i in sampled) for i in range(len(construction_sa))), error_message_builder("sampled_rows", str(factor))
+    f_column, bwt, sa_sample, isa_sample = fmindex_optimized.create_index_components(
+        construction_text, construction_sa, factor, factor)
+    assert bwt == construction_bwt and f_column.alphabet == construction_f_column.alphabet, \
+        error_message_builder("create_index_components", "bwt %d" % factor)
+    assert sa_sample.marks.bits == bitvector.create_bit_vector(sampled, len(construction_sa)).bits and \
+        list(sa_sample.values) == [construction_sa[i] for i in sampled], \
+        error_message_builder("create_index_components", "sa_sample %d" % factor)
+    assert list(isa_sample.values) == [construction_sa.index(p) for p in range(0, len(construction_sa), factor)] and \
+        list(isa_sample.terminal_values) == [0], error_message_builder("create_index_components", "isa_sample %d" % factor)
+    # factors below cumulative_tally_limit take running counts, the rest count block by block
+    tally = fmindex_optimized.create_tally(bwt, factor, len(f_column.alphabet))
+    assert list(tally.ranks) == [bwt[:min(row * factor, len(bwt))].count(code) for code in range(len(f_column.alphabet))
+                                 for row in range(tally.rows)], error_message_builder("create_ranks_tally", str(factor))
@@ -1,4 +1,21 @@
+import argparse
+import multiprocessing
 import sys
+from array import array
+
+
+def positive_int(value):
+    ivalue = int(value)
+    if ivalue <= 0:
+        raise argparse.ArgumentTypeError("%s is an invalid positive int value" % value)
+    return ivalue
+
+
+def non_negative_int(value):
+    ivalue = int(value)
+    if ivalue < 0:
+        raise argparse.ArgumentTypeError("%s is an invalid non-negative int value" % value)
+    return ivalue
 
 
 def get_size(obj, seen=None):
@@ -17,6 +34,20 @@ def get_size(obj, seen=None):
         size += sum([get_size(k, seen) for k in obj.keys()])
     elif hasattr(obj, '__dict__'):
         size += get_size(obj.__dict__, seen)
-    elif hasattr(obj, '__iter__') and not isinstance(obj, (str, bytes, bytearray)):
+    elif hasattr(obj, '__iter__') and not isinstance(obj, (str, bytes, bytearray, array)):
         size += sum([get_size(i, seen) for i in obj])
     return size
+
+
+def split_into_chunks(items, chunk_count):
+    """ Splits items into at most chunk_count consecutive chunks of nearly equal size """
+    size = max(1, -(-len(items) // chunk_count))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def parallel_map_chunks(function, items, workers, context=None, initializer=None, initargs=()):
+    """ Applies function to consecutive chunks of items on a pool of worker processes.
+    Returns concatenated results of all chunks in order of items. """
+    chunks = split_into_chunks(items, workers * 4)
+    with multiprocessing.get_context(context).Pool(workers, initializer, initargs) as pool:
+        return [result for chunk_results in pool.imap(function, chunks) for result in chunk_results]
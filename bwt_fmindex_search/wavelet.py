@@ -0,0 +1,57 @@
+from bitvector import *
+
+
+class WaveletMatrix:
+    """ Sequence of symbol codes stored as one bit vector per bit of a code, most significant bit first.
+     Every level is stably partitioned by its bit, zeros before ones, before it is passed to the next level.
+     Takes about n * log(alphabet size) bits and answers access and rank queries in O(log(alphabet size)). """
+    def __init__(self, levels, zeros, length):
+        self.levels = levels
+        self.zeros = zeros
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def memory_usage(self):
+        return sum(level.memory_usage() for level in self.levels)
+
+    def __getitem__(self, index):
+        code = 0
+        for level, zeros in zip(self.levels, self.zeros):
+            bit = level[index]
+            if bit:
+                index = zeros + level.rank(index)
+            else:
+                index -= level.rank(index)
+            code = code << 1 | bit
+        return code
+
+    def rank(self, code, index):
+        """ Returns number of occurrences of symbol code in sequence[:index] """
+        start = 0
+        shift = len(self.levels)
+        for level, zeros in zip(self.levels, self.zeros):
+            shift -= 1
+            if code >> shift & 1:
+                start = zeros + level.rank(start)
+                index = zeros + level.rank(index)
+            else:
+                start -= level.rank(start)
+                index -= level.rank(index)
+        return index - start
+
+    def rank_many(self, indices, codes):
+        return list(map(self.rank, codes, indices))
+
+
+def create_wavelet_matrix(codes, alphabet_size):
+    """ Creates wavelet matrix over sequence of integer codes smaller than alphabet_size """
+    levels = []
+    zeros = []
+    for shift in range(max(1, (alphabet_size - 1).bit_length()) - 1, -1, -1):
+        levels.append(create_bit_vector([i for i, code in enumerate(codes) if code >> shift & 1], len(codes)))
+        zero_codes = [code for code in codes if not code >> shift & 1]
+        zeros.append(len(zero_codes))
+        codes = zero_codes + [code for code in codes if code >> shift & 1]
+    return WaveletMatrix(levels, zeros, len(codes))